@@ -0,0 +1,767 @@
+### benchmark.py - Timing scripts for the diet planner
+### Run with: python benchmark.py
+
+import io
+import os
+import re
+import math
+import sys
+import time
+import glob
+import shutil
+import tempfile
+import subprocess
+from datetime import date, timedelta
+import diet_planner as diet
+
+sample_foods = ['artichoke', 'eggplant', 'broccoli', 'tomato', 'carrots', 'cheese', 'celery', 'peppers']
+sample_units = ['cup', 'teaspoon', 'tablespoon', 'gram', 'ounce']
+
+plan_dirs = [] # made by make_plan_dir, deleted by remove_plan_dirs
+
+### Helper Functions
+def make_recipe_text(i):
+    """ Returns the text of a synthetic recipe file """
+    lines = []
+    for j in range(4):
+        food = sample_foods[(i+j) % len(sample_foods)]
+        unit = sample_units[(i*j) % len(sample_units)]
+        lines.append(f"{(j+1)*0.5},{unit},{food}")
+    return (f"Name: Recipe {i}\n\nServings: {i%4+1}\n\nIngredients:\n" + "\n".join(lines) +
+            f"\n\nInstructions:\nMix everything for recipe {i}.")
+
+def make_plan_dir(n_recipes=20, n_meals=0):
+    """ Makes a temporary directory with a synthetic plan and changes into it (remove_plan_dirs deletes it) """
+    folder = tempfile.mkdtemp(prefix="diet_bench_")
+    plan_dirs.append(folder)
+    os.chdir(folder)
+    os.mkdir(diet.saved_recipes)
+    for i in range(n_recipes):
+        with open(f"{diet.saved_recipes}recipe_{i}.dat", 'w') as f:
+            f.write(make_recipe_text(i))
+    with open(diet.saved_diet, 'w') as f:
+        f.write("allowed,restricted,banned\nartichoke,eggplant,cheese\nbroccoli,tomato,\ncarrots,peppers,\n")
+    start = date(2020, 1, 1)
+    with open(diet.saved_meals, 'w') as f:
+        f.write(",".join(diet.meal_columns)+"\n")
+        for i in range(n_meals):
+            m_date = start+timedelta(days=i//4)
+            f.write(f"recipe_{i%n_recipes}.dat,{m_date},{diet.meal_categories[i%4]}\n")
+    return folder
+
+def remove_plan_dirs(cwd):
+    """ Changes back to cwd and deletes every directory made by make_plan_dir """
+    os.chdir(cwd)
+    while plan_dirs:
+        shutil.rmtree(plan_dirs.pop(), ignore_errors=True)
+
+def timed(func, repeat=1):
+    """ Returns the mean time (s) of calling func """
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter()-t0)/repeat
+
+def legacy_parse_recipe(filestring):
+    """ The old regex + pandas.read_csv recipe parser, kept for comparison """
+    import pandas as pd
+    regex = "("+"|".join(diet.recipe_labels.values())+")"
+    file_list = re.split(regex, filestring)
+    file_list = list(filter(None, file_list))
+    fields = {}
+    for var,label in diet.recipe_labels.items():
+        if file_list.index(label)+1==len(file_list) or file_list[file_list.index(label)+1] in diet.recipe_labels.values():
+            fields[var] = diet.defaults[var]
+            continue
+        value = file_list[file_list.index(label)+1]
+        if var=='servings':
+            value = float(value)
+            continue
+        if var=='ingredients':
+            s = io.StringIO(value)
+            data = pd.read_csv(s, header=None, names=diet.ingredient_columns)
+            value = [[data.quantity[i], data.units[i], data.food[i]] for i in range(len(data.food))]
+        fields[var] = value
+    return fields
+
+def legacy_check_plan(meals, diet_lists):
+    """ The old pint-based calc_foods + check_foods, kept for comparison """
+    foods = {}
+    for meal in meals:
+        for food_name, amount in meal.ingredients.items():
+            if food_name in foods:
+                foods[food_name] += amount.to(foods[food_name].units)
+            else:
+                foods[food_name] = amount
+    restricted = 0*diet.measure_unit
+    other = 0*diet.measure_unit
+    for food_name, amount in foods.items():
+        if food_name in diet_lists['banned'] or food_name in diet_lists['restricted']:
+            restricted += amount.to(diet.measure_unit)
+        else:
+            other += amount.to(diet.measure_unit)
+    if restricted == 0:
+        return True, 0
+    percent = (restricted/(restricted+other)).magnitude
+    return percent <= 0.2, percent
+
+### Benchmarks
+def bench_mutations(sizes=(100, 1000, 10000), n_recipes=20, repeat=50):
+    """ Per-mutation cost of add_meal/remove_meal as the plan grows """
+    cwd = os.getcwd()
+    make_plan_dir(n_recipes)
+    try:
+        plan = diet.MealPlan()
+        start = date(2020, 1, 1)
+        print("meals      add_meal (ms)   remove_meal (ms)")
+        for size in sizes:
+            # Grow the plan to the target size
+            while len(plan.meals) < size:
+                i = len(plan.meals)
+                m = diet.Meal(f"recipe_{i%n_recipes}.dat", m_date=start+timedelta(days=i//4),
+                              category=diet.meal_categories[i%4], registry=plan.registry)
+                plan.add_meal(m)
+            # Time new meals on dates past the end of the plan
+            extra = [diet.Meal(f"recipe_{i%n_recipes}.dat", m_date=start+timedelta(days=size+i),
+                               category='snack', registry=plan.registry) for i in range(repeat)]
+            t0 = time.perf_counter()
+            for m in extra:
+                plan.add_meal(m)
+            t_add = (time.perf_counter()-t0)/repeat
+            t0 = time.perf_counter()
+            for m in extra:
+                plan.remove_meal(m)
+            t_remove = (time.perf_counter()-t0)/repeat
+            print(f"{size:<10d} {t_add*1e3:<15.3f} {t_remove*1e3:.3f}")
+    finally:
+        remove_plan_dirs(cwd)
+
+def bench_load(sizes=(1000, 10000), n_recipes=20):
+    """ MealPlan load time for a fixed recipe library and a growing meal history """
+    cwd = os.getcwd()
+    try:
+        print("meals      load (s)")
+        for size in sizes:
+            make_plan_dir(n_recipes, size)
+            print(f"{size:<10d} {timed(diet.MealPlan):.3f}")
+    finally:
+        remove_plan_dirs(cwd)
+
+def bench_parallel(n_recipes=20000, workers=(1, 2, 4), pool='process'):
+    """ Cold-start recipe loading time against the number of workers """
+    cwd = os.getcwd()
+    make_plan_dir(n_recipes)
+    try:
+        print(f"recipes: {n_recipes}, cores: {os.cpu_count()}")
+        print("workers    load (s)")
+        for n in workers:
+            print(f"{n:<10d} {timed(lambda: diet.MealPlan(workers=n, pool=pool, snapshot_file=None)):.3f}")
+    finally:
+        remove_plan_dirs(cwd)
+
+def bench_parser(n_recipes=5000):
+    """ Hand-written recipe parser against the old pandas-based one """
+    cwd = os.getcwd()
+    make_plan_dir(n_recipes)
+    try:
+        paths = sorted(glob.glob(diet.saved_recipes+"*"))
+        def parse_all(parser):
+            for path in paths:
+                with open(path) as f:
+                    parser(f.read())
+        t_old = timed(lambda: parse_all(legacy_parse_recipe))
+        t_new = timed(lambda: parse_all(diet.parse_recipe))
+        print(f"recipes: {n_recipes}")
+        print(f"legacy parser: {t_old:.3f} s ({t_old/n_recipes*1e6:.1f} us/file)")
+        print(f"new parser:    {t_new:.3f} s ({t_new/n_recipes*1e6:.1f} us/file)")
+        print(f"speedup:       {t_old/t_new:.1f}x")
+    finally:
+        remove_plan_dirs(cwd)
+
+def bench_check(days=365, n_recipes=20):
+    """ Diet check over a year of meals: gram table against pint arithmetic """
+    cwd = os.getcwd()
+    make_plan_dir(n_recipes, days*4)
+    try:
+        plan = diet.MealPlan()
+        start = date(2020, 1, 1)
+        meals = plan.get_meals(start, days)
+        t_old = timed(lambda: legacy_check_plan(meals, plan.diet), repeat=3)
+        t_new = timed(lambda: plan.check_plan(start, days), repeat=20)
+        old = legacy_check_plan(meals, plan.diet)
+        new = plan.check_plan(start, days)
+        # The year evens out, so compare each week too
+        for d in (start+timedelta(days=week) for week in range(0, days-6, 7)):
+            old_week, new_week = legacy_check_plan(plan.get_meals(d, 7), plan.diet), plan.check_plan(d, 7)
+            assert old_week[0]==new_week[0] and math.isclose(old_week[1], new_week[1], rel_tol=1e-9, abs_tol=1e-12), \
+                (d, old_week, new_week)
+        assert old[0]==new[0] and math.isclose(old[1], new[1], rel_tol=1e-9, abs_tol=1e-12), (old, new)
+        print(f"meals: {len(meals)}")
+        print(f"pint:       {t_old*1e3:.2f} ms  percent={old[1]:.6f}")
+        print(f"gram table: {t_new*1e3:.2f} ms  percent={new[1]:.6f}")
+    finally:
+        remove_plan_dirs(cwd)
+
+def bench_units(n_lines=20000):
+    """ Unit string parsing for a large library, with and without the cache """
+    names = [sample_units[i % len(sample_units)] for i in range(n_lines)]
+    t_old = timed(lambda: [diet.units(name) for name in names])
+    diet.parse_unit.cache_clear()
+    t_new = timed(lambda: [diet.parse_unit(name) for name in names])
+    print(f"ingredient lines: {n_lines}")
+    print(f"units(name):      {t_old*1e3:.1f} ms")
+    print(f"parse_unit(name): {t_new*1e3:.1f} ms  {diet.parse_unit.cache_info()}")
+
+def bench_diet_index(n_lookups=100000):
+    """ Diet class lookups through the normalized index, and the plural forms it must match """
+    listed = {'banned': ['cookie', 'quiche', 'brioche', 'white potato'], 'restricted': ['berry', 'peach', 'tomato']}
+    index = diet.DietIndex(listed)
+    plurals = {'cookies': 'banned', 'quiches': 'banned', 'Brioches': 'banned', 'White  Potatoes': 'banned',
+               'berries': 'restricted', 'peaches': 'restricted', 'tomatoes': 'restricted', 'carrots': 'allowed'}
+    for food, category in plurals.items():
+        assert index.classify(food)==category, f"{food} classified {index.classify(food)}, expected {category}"
+    foods = [sample_foods[i % len(sample_foods)]+"s" for i in range(n_lookups)]
+    t_lookup = timed(lambda: [index.classify(food) for food in foods])
+    print(f"plural forms checked: {len(plurals)}")
+    print(f"classify: {t_lookup/n_lookups*1e9:.0f} ns per lookup")
+
+def bench_scoring(n_recipes=5000):
+    """ Re-scoring a whole library: sparse matrix against per-recipe checks """
+    cwd = os.getcwd()
+    make_plan_dir(n_recipes)
+    try:
+        plan = diet.MealPlan()
+        t_old = timed(lambda: [plan.check_recipe(recipe) for recipe in plan.recipes])
+        old = [(recipe.accept, recipe.percent) for recipe in plan.recipes]
+        t_new = timed(plan.check_recipes, repeat=10)
+        new = [(recipe.accept, recipe.percent) for recipe in plan.recipes]
+        for (old_ok, old_pct), (new_ok, new_pct) in zip(old, new):
+            assert old_ok==new_ok and math.isclose(old_pct, new_pct, rel_tol=1e-9, abs_tol=1e-12), \
+                (old_ok, old_pct, new_ok, new_pct)
+        print(f"recipes: {n_recipes}")
+        print(f"per recipe:    {t_old*1e3:.1f} ms")
+        print(f"sparse matrix: {t_new*1e3:.1f} ms")
+    finally:
+        remove_plan_dirs(cwd)
+
+def bench_windows(days=365*3, n_recipes=20):
+    """ Sliding 7-day compliance over years of meals: prefix sums against per-window sums """
+    cwd = os.getcwd()
+    make_plan_dir(n_recipes, days*4)
+    try:
+        plan = diet.MealPlan()
+        start = date(2020, 1, 1)
+        end = start+timedelta(days=days)
+        def per_window():
+            results = []
+            d = start
+            while d < end:
+                results.append(diet.check_foods(diet.calc_foods(plan.get_meals(d, 7)), plan.diet_index))
+                d += timedelta(days=1)
+            return results
+        t_old = timed(per_window)
+        plan.totals = None
+        t_build = timed(plan.daily_totals)
+        t_all = timed(lambda: plan.check_windows(start, end, 7), repeat=10)
+        t_one = timed(lambda: plan.check_plan(start+timedelta(days=100), 7), repeat=1000)
+        accept, percent = plan.check_windows(start, end, 7)
+        windows = per_window()
+        assert len(windows)==len(accept)==days
+        for (old_ok, old_pct), ok, pct in zip(windows, accept.tolist(), percent.tolist()):
+            assert old_ok==ok and math.isclose(old_pct, pct, rel_tol=1e-9, abs_tol=1e-12), (old_ok, old_pct, ok, pct)
+        print(f"meals: {len(plan.meals)}, windows: {days}")
+        print(f"per-window sums:     {t_old*1e3:.1f} ms")
+        print(f"prefix sums (build): {t_build*1e3:.2f} ms")
+        print(f"check_windows:       {t_all*1e3:.3f} ms")
+        print(f"check_plan:          {t_one*1e6:.1f} us")
+    finally:
+        remove_plan_dirs(cwd)
+
+def bench_storage(n_recipes=2000, n_meals=10000, repeat=50):
+    """ Load and mutation times for the csv/text files against SQLite """
+    cwd = os.getcwd()
+    make_plan_dir(n_recipes, n_meals)
+    try:
+        db = diet.migrate_to_sqlite("plan.db")
+        storages = {'files': diet.FileStorage(), 'sqlite': db}
+        start = date(2030, 1, 1)
+        print(f"recipes: {n_recipes}, meals: {n_meals}")
+        print("storage    load (s)   add_meal (ms)   remove_meal (ms)   saved week (ms)")
+        weeks = {}
+        for label, storage in storages.items():
+            t_load = timed(lambda: diet.MealPlan(storage=storage))
+            plan = diet.MealPlan(storage=storage)
+            extra = [diet.Meal(f"recipe_{i%n_recipes}.dat", m_date=start+timedelta(days=i), category='snack',
+                               registry=plan.registry) for i in range(repeat)]
+            t_add = timed(lambda: [plan.add_meal(m) for m in extra])/repeat
+            t_remove = timed(lambda: [plan.remove_meal(m) for m in extra])/repeat
+            week = date(2020, 6, 1)
+            t_week = timed(lambda: plan.get_saved_meals(week, 7), repeat=repeat)
+            weeks[label] = sorted(plan.get_saved_meals(week, 7))
+            print(f"{label:<10s} {t_load:<10.3f} {t_add*1e3:<15.3f} {t_remove*1e3:<18.3f} {t_week*1e3:.3f}")
+        assert weeks['files']==weeks['sqlite'] and weeks['files'], "storages disagree on the saved week"
+        db.close()
+    finally:
+        remove_plan_dirs(cwd)
+
+def bench_writes(n_recipes=2000, n_meals=10000):
+    """ Cost of saving a plan when little has changed """
+    cwd = os.getcwd()
+    make_plan_dir(n_recipes, n_meals)
+    try:
+        plan = diet.MealPlan()
+        def write_all():
+            for recipe in plan.recipes:
+                recipe.to_file()
+            plan.writes.save_diet()
+            plan.writes.save_meals()
+            plan.writes.flush()
+        def one_recipe():
+            plan.recipes[0].name = "Changed"
+            plan.to_file()
+        t_all = timed(write_all)
+        t_none = timed(plan.to_file, repeat=10)
+        t_one = timed(one_recipe, repeat=10)
+        print(f"recipes: {n_recipes}, meals: {n_meals}")
+        print(f"rewrite everything:    {t_all*1e3:.1f} ms")
+        print(f"to_file, nothing new:  {t_none*1e3:.2f} ms")
+        print(f"to_file, one recipe:   {t_one*1e3:.2f} ms")
+    finally:
+        remove_plan_dirs(cwd)
+
+def bench_batch(n_meals=1000, n_recipes=20):
+    """ Importing meals one add_meal at a time against a single batch """
+    cwd = os.getcwd()
+    make_plan_dir(n_recipes)
+    try:
+        for label, storage in (('files', None), ('sqlite', diet.SQLiteStorage("plan.db"))):
+            plan = diet.MealPlan(storage=storage)
+            start = date(2020, 1, 1)
+            def make_meals(offset):
+                return [diet.Meal(f"recipe_{i%n_recipes}.dat", m_date=start+timedelta(days=offset+i//4),
+                                  category=diet.meal_categories[i%4], registry=plan.registry)
+                        for i in range(n_meals)]
+            singles, batched = make_meals(0), make_meals(n_meals)
+            t_single = timed(lambda: [plan.add_meal(m) for m in singles])
+            t_batch = timed(lambda: plan.add_meals(batched))
+            print(f"{label}: {n_meals} add_meal calls {t_single*1e3:.1f} ms, one add_meals {t_batch*1e3:.1f} ms")
+    finally:
+        remove_plan_dirs(cwd)
+
+def bench_cascade(n_meals=(100, 1000, 10000), n_recipes=20):
+    """ Deleting a recipe used by many meals """
+    cwd = os.getcwd()
+    try:
+        print("dependent meals   remove_recipe (ms)")
+        for n in n_meals:
+            make_plan_dir(n_recipes, n*n_recipes)
+            plan = diet.MealPlan()
+            recipe = plan.recipes[0]
+            count = len(plan.get_recipe_meals(recipe))
+            print(f"{count:<17d} {timed(lambda: plan.remove_recipe(recipe))*1e3:.1f}")
+    finally:
+        remove_plan_dirs(cwd)
+
+def bench_identity(sizes=(1000, 10000, 50000), n_recipes=20, repeat=1000):
+    """ Duplicate checks and removals against the meal store vs a list scan """
+    cwd = os.getcwd()
+    try:
+        print("meals      list in (us)   store in (us)   remove+add (us)")
+        for size in sizes:
+            make_plan_dir(n_recipes, size)
+            plan = diet.MealPlan()
+            # Probe with the newest meals, the worst case for a list scan
+            probes = [meal.copy() for meal in list(plan.meals)[-repeat:]]
+            meal_list = list(plan.meals)
+            t_list = timed(lambda: [meal in meal_list for meal in probes])/repeat
+            t_store = timed(lambda: [meal in plan.meals for meal in probes])/repeat
+            def churn():
+                with plan.batch():
+                    for meal in probes:
+                        plan.remove_meal(meal)
+                        plan.add_meal(meal)
+            t_churn = timed(churn)/repeat
+            print(f"{size:<10d} {t_list*1e6:<14.2f} {t_store*1e6:<15.2f} {t_churn*1e6:.2f}")
+    finally:
+        remove_plan_dirs(cwd)
+
+def bench_table(sizes=(10000, 100000), n_recipes=20, repeat=100):
+    """ Per-meal memory and day/category queries on the columnar meal table """
+    import tracemalloc
+    cwd = os.getcwd()
+    try:
+        print("meals      objects (B/meal)   table (B/meal)   list day query (us)   table day query (us)")
+        for size in sizes:
+            make_plan_dir(n_recipes, size)
+            plan = diet.MealPlan()
+            # One object per meal, as the plan used to hold them
+            tracemalloc.start()
+            meals = list(plan.meals)
+            keyed = {diet.meal_key(meal): meal for meal in meals}
+            object_bytes = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            tracemalloc.start()
+            table = diet.MealStore(meals)
+            table_bytes = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            day = meals[len(meals)//2].date
+            t_list = timed(lambda: [m for m in meals if m.date==day and m.category=='dinner'], repeat)
+            t_table = timed(lambda: table.between(day, day+timedelta(days=1), 'dinner'), repeat)
+            print(f"{size:<10d} {object_bytes/size:<18.0f} {table_bytes/size:<16.0f} {t_list*1e6:<21.1f} "
+                  f"{t_table*1e6:.1f}")
+            del keyed
+    finally:
+        remove_plan_dirs(cwd)
+
+def bench_startup(n_recipes=5000, n_meals=50000):
+    """ MealPlan start time without a snapshot, with a fresh one, and after one recipe file changed """
+    cwd = os.getcwd()
+    make_plan_dir(n_recipes, n_meals)
+    try:
+        print(f"recipes: {n_recipes}, meals: {n_meals}")
+        print(f"no snapshot:    {timed(lambda: diet.MealPlan(snapshot_file=None)):.3f} s")
+        print(f"cold (writes):  {timed(diet.MealPlan):.3f} s")
+        print(f"warm:           {timed(diet.MealPlan):.3f} s")
+        with open(f"{diet.saved_recipes}recipe_0.dat", 'a') as f:
+            f.write(" Serve warm.")
+        print(f"1 file changed: {timed(diet.MealPlan):.3f} s")
+    finally:
+        remove_plan_dirs(cwd)
+
+def import_times(code, modules):
+    """ Runs code in a fresh interpreter with -X importtime; returns cumulative ms per module (None if not imported) """
+    env = dict(os.environ, QT_QPA_PLATFORM=os.environ.get('QT_QPA_PLATFORM', 'offscreen'))
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)), env=env)
+    times = {}
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            _, cumulative, name = line.split("|")
+            if name.strip() in modules:
+                times[name.strip()] = int(cumulative)/1e3
+    return {module: times.get(module) for module in modules}
+
+def bench_import(repeat=5):
+    """ Import time of diet_planner (and diet_app) and whether pandas/pint load at import """
+    modules = ['diet_planner', 'pandas', 'pint', 'diet_app']
+    cases = [("headless", "import diet_planner"),
+             ("first unit", "import diet_planner; diet_planner.parse_unit('cup')"),
+             ("gui", "import diet_app")]
+    print("case         " + "".join(f"{m+' (ms)':<20s}" for m in modules))
+    for label, code in cases:
+        # Best of several runs, since a cold disk cache skews the first one
+        runs = [import_times(code, modules) for _ in range(repeat)]
+        best = {m: min((r[m] for r in runs if r[m] is not None), default=None) for m in modules}
+        print(f"{label:<13s}" + "".join(f"{'-' if best[m] is None else f'{best[m]:.1f}':<20s}" for m in modules))
+
+def bench_gui_tasks(n_recipes=2000, n_meals=20000):
+    """ Time the GUI thread is held by a recipe removal: inline vs queued on the model's worker """
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from PyQt5 import QtWidgets as qtw
+    import diet_app
+    cwd = os.getcwd()
+    make_plan_dir(n_recipes, n_meals)
+    try:
+        app = qtw.QApplication.instance() or qtw.QApplication([])
+        model = diet_app.DietModel()
+        plan = model.meal_plan
+        print(f"recipes: {n_recipes}, meals: {n_meals}")
+        t_inline = timed(lambda: plan.remove_recipe(plan.recipes[0]))
+        t_queued = timed(lambda: model.run_task(plan.remove_recipe, plan.recipes[1]))
+        t_done = t_queued+timed(model.wait_for_tasks)
+        app.processEvents()
+        print(f"inline:          {t_inline*1e3:.1f} ms on the GUI thread")
+        print(f"queued:          {t_queued*1e3:.1f} ms on the GUI thread ({t_done*1e3:.1f} ms until done)")
+        plan.to_file()
+    finally:
+        remove_plan_dirs(cwd)
+
+def bench_gui_refresh(n_recipes=50, n_meals=8000, weeks=20):
+    """ Week-to-week refresh of the day panel: recycled DayBoxes vs building new ones """
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from PyQt5 import QtWidgets as qtw
+    import diet_app
+    cwd = os.getcwd()
+    make_plan_dir(n_recipes, n_meals)
+    try:
+        app = qtw.QApplication.instance() or qtw.QApplication([])
+        app.setStyleSheet(diet_app.stylesheet)
+        model = diet_app.DietModel()
+        model.set_date(date(2020, 1, 6))
+        panel = diet_app.MainDayPanel(model)
+        panel.show()
+        mondays = [date(2020, 1, 6)+timedelta(weeks=i) for i in range(weeks)]
+        def recycled():
+            for monday in mondays:
+                model.set_date(monday) # model_changed -> panel.populate_days()
+                app.processEvents()
+        def rebuilt():
+            # What populate_days used to do: new DayBoxes (and all their children) every time
+            for monday in mondays:
+                boxes = [diet_app.DayBox(monday+timedelta(days=i), model) for i in range(7)]
+                for box in boxes:
+                    panel.layout.addWidget(box, 1)
+                app.processEvents()
+                for box in boxes:
+                    box.setParent(None)
+                    box.deleteLater()
+        recycled() # first pass creates the boxes
+        print(f"meals: {n_meals} (4 a day), weeks: {weeks}")
+        print(f"rebuild:  {timed(rebuilt)/weeks*1e3:.1f} ms per week")
+        print(f"recycled: {timed(recycled)/weeks*1e3:.1f} ms per week")
+    finally:
+        remove_plan_dirs(cwd)
+
+def bench_gui_sidebar(sizes=(500, 5000), repeat=3):
+    """ Refreshing the sidebar recipe list: a MealBox per recipe vs the paged list model """
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from PyQt5 import QtWidgets as qtw
+    import diet_app
+    cwd = os.getcwd()
+    try:
+        app = qtw.QApplication.instance() or qtw.QApplication([])
+        app.setStyleSheet(diet_app.stylesheet)
+        print("recipes    widgets (ms)   list model (ms)")
+        for size in sizes:
+            make_plan_dir(size)
+            model = diet_app.DietModel()
+            frame = qtw.QFrame()
+            frame.setLayout(qtw.QVBoxLayout())
+            frame.show()
+            def widgets():
+                # What the sidebar used to do on every model_changed
+                boxes = [diet_app.MealBox(model, meal=recipe, is_recipe=True) for recipe in model.meal_plan.recipes]
+                for box in boxes:
+                    frame.layout().addWidget(box)
+                app.processEvents()
+                for box in boxes:
+                    box.setParent(None)
+                    box.deleteLater()
+            view = qtw.QListView()
+            view.setModel(model.recipe_model)
+            view.setItemDelegate(diet_app.RecipeDelegate(view))
+            view.setUniformItemSizes(True)
+            view.show()
+            def listed():
+                model.recipe_model.refresh()
+                app.processEvents()
+            t_widgets = timed(widgets, repeat)
+            t_list = timed(listed, repeat)
+            print(f"{size:<10d} {t_widgets*1e3:<14.1f} {t_list*1e3:.1f}")
+    finally:
+        remove_plan_dirs(cwd)
+
+def bench_gui_month(n_recipes=50, days=730, months=12):
+    """ Month view with 5 meals a day: 31 recycled DayBoxes vs the painted calendar grid """
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from PyQt5 import QtWidgets as qtw
+    import diet_app
+    cwd = os.getcwd()
+    make_plan_dir(n_recipes, days*4)
+    try:
+        # A fifth meal every day
+        with open(diet.saved_meals, 'a') as f:
+            for i in range(days):
+                f.write(f"recipe_{(i+7) % n_recipes}.dat,{date(2020, 1, 1)+timedelta(days=i)},snack\n")
+        app = qtw.QApplication.instance() or qtw.QApplication([])
+        app.setStyleSheet(diet_app.stylesheet)
+        model = diet_app.DietModel()
+        model.set_date(date(2020, 1, 1))
+        panel = diet_app.MainDayPanel(model)
+        panel.resize(1400, 800)
+        panel.show()
+        firsts = [date(2020+m//12, m%12+1, 1) for m in range(months)]
+        def browse():
+            for first in firsts:
+                model.set_date(first) # model_changed -> panel.read_model()
+                app.processEvents()
+                panel.repaint()
+        model.set_scale(31) # the old way to see a month: a DayBox per day
+        browse()
+        t_boxes = timed(browse)/months
+        model.set_scale('month')
+        browse()
+        t_grid = timed(browse)/months
+        viewport = panel.calendar_view.viewport()
+        t_paint = timed(viewport.repaint, repeat=50)
+        print(f"meals: {days*5} (5 a day), months: {months}")
+        print(f"31 DayBoxes:   {t_boxes*1e3:.1f} ms per month")
+        print(f"calendar grid: {t_grid*1e3:.1f} ms per month, {t_paint*1e3:.2f} ms per redraw")
+    finally:
+        model.wait_for_tasks()
+        remove_plan_dirs(cwd)
+
+def bench_gui_paging(n_recipes=50, n_meals=8000, pages=20):
+    """ Arrow-button paging through weeks and months: prefetched windows vs building them at click time """
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from PyQt5 import QtWidgets as qtw
+    import diet_app
+    cwd = os.getcwd()
+    make_plan_dir(n_recipes, n_meals)
+    try:
+        app = qtw.QApplication.instance() or qtw.QApplication([])
+        app.setStyleSheet(diet_app.stylesheet)
+        model = diet_app.DietModel()
+        # Title bar and day panel laid out together, as in the main window
+        window = qtw.QWidget()
+        layout = qtw.QVBoxLayout(window)
+        title = diet_app.MainTitleBar(model)
+        panel = diet_app.MainDayPanel(model)
+        layout.addWidget(title)
+        layout.addWidget(panel)
+        window.resize(1400, 850)
+        window.show()
+        def settle():
+            # The user looking at the page: background prefetches finish and report back
+            app.processEvents()
+            model.prefetch_pool.waitForDone()
+            app.processEvents()
+        def page(scale, cache_size):
+            diet_app.window_cache_size = cache_size
+            model.windows.clear()
+            model.set_scale(scale)
+            model.set_date(date(2020, 1, 6))
+            settle()
+            total = 0
+            for _ in range(pages):
+                t0 = time.perf_counter()
+                model.increment_date()
+                app.processEvents()
+                total += time.perf_counter()-t0
+                settle()
+            return total/pages
+        print(f"meals: {n_meals}, pages: {pages}")
+        for scale in (7, 'month'):
+            t_click = page(scale, 0)
+            t_prefetch = page(scale, 8)
+            print(f"{scale!s:>5}: built on click {t_click*1e3:.1f} ms, prefetched {t_prefetch*1e3:.1f} ms per page")
+        diet_app.window_cache_size = 8
+    finally:
+        model.wait_for_tasks()
+        remove_plan_dirs(cwd)
+
+def bench_search(n_recipes=50000, repeat=200):
+    """ Recipe search: inverted index vs scanning every recipe's text """
+    styles = ['roasted', 'spicy', 'creamy', 'grilled', 'baked', 'smoky', 'lemon', 'garlic', 'herbed', 'crispy']
+    dishes = ['soup', 'salad', 'stew', 'pasta', 'curry', 'casserole', 'tacos', 'risotto', 'bowl', 'gratin']
+    methods = ['simmer', 'roast', 'whisk', 'saute', 'blend', 'toss', 'braise', 'grill']
+    recipes = []
+    for i in range(n_recipes):
+        foods = [sample_foods[(i*7+j) % len(sample_foods)] for j in range(3)]
+        fields = {'name': f"{styles[i % 10]} {foods[0]} {dishes[(i//10) % 10]} {i}",
+                  'servings': 2,
+                  'ingredients': [[1.0, 'cup', food] for food in foods],
+                  'instructions': f"{methods[i % 8]} the {foods[1]}, then {methods[(i//8) % 8]} until done."}
+        recipes.append(diet.Recipe(f"recipe_{i}.dat", recipe_dir="", fields=fields))
+    t0 = time.perf_counter()
+    index = diet.RecipeSearch(recipes)
+    print(f"recipes: {n_recipes}, words: {len(index.words)}, build: {time.perf_counter()-t0:.2f} s")
+    print(f"re-sync with nothing changed: {timed(lambda: index.sync(recipes))*1e3:.0f} ms")
+    def edit_some():
+        for recipe in recipes[::n_recipes//500]:
+            recipe.instructions += " Serve warm."
+        index.sync(recipes)
+    print(f"re-sync after 500 edits:      {timed(edit_some)*1e3:.0f} ms")
+    def scan(query):
+        words = query.lower().split()
+        found = []
+        for recipe in recipes:
+            text = " ".join([recipe.name, *recipe.grams(), recipe.instructions]).lower()
+            if all(word in text for word in words):
+                found.append(recipe)
+                if len(found)==50:
+                    break
+        return found
+    print("query                  matches   index (us)   scan (us)")
+    # Typing one or two letters after a common word is the usual search-as-you-type shape
+    for query in ['curry', 'sp', 'creamy tom', 'braise eggplant risotto', 'gril art stew 4', 'tomato c', 'stew 4',
+                  'the c', 'zzz']:
+        t_index = timed(lambda: index.search(query, 50), repeat)
+        t_scan = timed(lambda: scan(query), max(1, repeat//50))
+        print(f"{query:<22s} {len(index.search(query, 50)):<9d} {t_index*1e6:<12.1f} {t_scan*1e6:.0f}")
+
+def bench_rescore(n_recipes=5000, n_foods=400, days=365):
+    """ Adding diet foods: re-scoring the recipes that use them against re-scoring everything """
+    cwd = os.getcwd()
+    make_plan_dir(0)
+    try:
+        foods = [f"food {k}" for k in range(n_foods)]
+        for i in range(n_recipes):
+            lines = [f"1,cup,{foods[(i*7+j*31) % n_foods]}" for j in range(8)]
+            with open(f"{diet.saved_recipes}recipe_{i}.dat", 'w') as f:
+                f.write(f"Name: Recipe {i}\n\nServings: 2\n\nIngredients:\n"+"\n".join(lines)+"\n\nInstructions:\nMix.")
+        start = date(2020, 1, 1)
+        with open(diet.saved_meals, 'w') as f:
+            f.write(",".join(diet.meal_columns)+"\n")
+            for i in range(days*4):
+                f.write(f"recipe_{i % 50}.dat,{start+timedelta(days=i//4)},{diet.meal_categories[i%4]}\n")
+        plan = diet.MealPlan(snapshot_file=None)
+        plan.check_plan(start, days)
+        edits = [(foods[k], ['restricted', 'banned'][k % 2]) for k in range(0, n_foods, 7)]
+        def full():
+            for food, category in edits:
+                plan.diet[category].append(food)
+                plan.diet_index = diet.DietIndex(plan.diet)
+                plan.save_diet()
+                plan.check_recipes()
+                plan.check_plan(start, days)
+                plan.diet[category].remove(food)
+                plan.diet_index = diet.DietIndex(plan.diet)
+                plan.save_diet()
+                plan.check_recipes()
+                plan.check_plan(start, days)
+        def targeted():
+            for food, category in edits:
+                plan.add_food(food, category)
+                plan.check_plan(start, days)
+                plan.remove_food(food)
+                plan.check_plan(start, days)
+        t_full = timed(full)/len(edits)/2
+        t_new = timed(targeted)/len(edits)/2
+        # The targeted scores must match a full re-score
+        for food, category in edits[:5]:
+            plan.add_food(food, category)
+        scores = [(recipe.accept, recipe.percent) for recipe in plan.recipes]
+        plan.check_recipes()
+        assert scores==[(recipe.accept, recipe.percent) for recipe in plan.recipes]
+        print(f"recipes: {n_recipes}, foods: {n_foods}, recipes per food: {len(plan.recipes_using(foods[0]))}")
+        print(f"full re-score:     {t_full*1e3:.2f} ms per edit")
+        print(f"targeted re-score: {t_new*1e3:.2f} ms per edit")
+    finally:
+        plan.writes.clear()
+        remove_plan_dirs(cwd)
+
+benchmarks = {
+    'mutations': bench_mutations,
+    'load': bench_load,
+    'parallel': bench_parallel,
+    'parser': bench_parser,
+    'check': bench_check,
+    'units': bench_units,
+    'diet_index': bench_diet_index,
+    'scoring': bench_scoring,
+    'windows': bench_windows,
+    'storage': bench_storage,
+    'writes': bench_writes,
+    'batch': bench_batch,
+    'cascade': bench_cascade,
+    'identity': bench_identity,
+    'table': bench_table,
+    'startup': bench_startup,
+    'import': bench_import,
+    'gui_tasks': bench_gui_tasks,
+    'gui_refresh': bench_gui_refresh,
+    'gui_sidebar': bench_gui_sidebar,
+    'gui_month': bench_gui_month,
+    'gui_paging': bench_gui_paging,
+    'search': bench_search,
+    'rescore': bench_rescore,
+}
+
+if __name__ == '__main__':
+    # Run the benchmarks named on the command line (default: all)
+    names = sys.argv[1:] or list(benchmarks)
+    for name in names:
+        print(f"### {name}")
+        benchmarks[name]()
+        print()
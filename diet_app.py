@@ -5,8 +5,11 @@ from PyQt5 import QtWidgets as qtw, QtGui as qtg, QtCore as qtc
 import diet_planner as diet
 import io
 import os
+from collections import OrderedDict
 
 days = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+search_limit = 200 # most recipes the Add Meal list offers, searching or not
+window_cache_size = 8 # date windows (the one shown and its neighbors) kept by the model
 
 ### Stylesheet for now
 stylesheet = """
@@ -39,6 +42,23 @@ def clear_widget(widget, children):
         child.destroy()
     widget.children = []
 
+def set_status(widget, status):
+    """ Sets a widget's objectName for the app stylesheet, re-polishing only if it changed """
+    if widget.objectName()!=status:
+        widget.setObjectName(status)
+        widget.style().unpolish(widget)
+        widget.style().polish(widget)
+
+def meal_status(percent):
+    """ Returns the stylesheet status (bad, medium or good) for a restricted food fraction """
+    if percent > 0.4:
+        return "bad"
+    elif percent > 0.2:
+        return "medium"
+    return "good"
+
+status_colors = {"bad": qtg.QColor("red"), "medium": qtg.QColor("orange"), "good": qtg.QColor("green")}
+
 def ingr_to_dict(ingr_string):
     """ Returns a dictionary from a readable string of ingredients """
     if ingr_string=="" or ingr_string.isspace():
@@ -50,7 +70,7 @@ def ingr_to_dict(ingr_string):
         if len(text[i])>3:
             for j in range(3, len(text[i])):
                 text[i][2]+=" "+text[i][j]
-    text = {line[2]: float(line[0])*diet.units(line[1]) for line in text}
+    text = {line[2]: float(line[0])*diet.parse_unit(line[1]) for line in text}
     return text
 
 def dict_to_ingr(ingr_dict):
@@ -74,29 +94,136 @@ def from_qdate(qdate):
 def from_date(r_date):
     return qtc.QDate(r_date.year, r_date.month, r_date.day)
 
+############################################### Background Work ################################################
+class TaskSignals(qtc.QObject):
+    
+    # QRunnable isn't a QObject, so a task reports back through one of these
+    finished = qtc.pyqtSignal()
+    failed = qtc.pyqtSignal(str)
+    result = qtc.pyqtSignal(object)
+
+class PlanTask(qtc.QRunnable):
+    
+    def __init__(self, func, *args):
+        """ Runs func(*args) on a worker thread """
+        super().__init__()
+        self.func = func
+        self.args = args
+        self.signals = TaskSignals()
+    
+    def run(self):
+        try:
+            self.signals.result.emit(self.func(*self.args))
+        except Exception as e:
+            self.signals.failed.emit(str(e))
+        self.signals.finished.emit()
+
+class PlanWindow:
+    
+    def __init__(self, meal_plan, start, n_days, grid=False):
+        """
+        The meals shown for a date range and the diet checks over it
+        A grid window also covers the whole weeks around the range, for the calendar grid
+        """
+        self.start = start
+        self.n_days = n_days
+        self.first = diet.find_week_start(start) if grid else start # first day shown
+        end = start+timedelta(days=n_days)
+        self.weeks = -(-(end-self.first).days//7)
+        last = self.first+timedelta(weeks=self.weeks) if grid else end # day after the last one shown
+        self.last = last
+        self.meals = {} # date -> that day's meals, in category order
+        for meal in meal_plan.get_meals(self.first, (last-self.first).days):
+            self.meals.setdefault(meal.date, []).append(meal)
+        self.accept, self.percent = meal_plan.check_plan(start, n_days)
+        # Per-day status (None for days without meals), from one check per day
+        accept, percent = meal_plan.check_windows(self.first, last, days=1)
+        self.status = [None if self.first+timedelta(days=i) not in self.meals
+                       else meal_status(p) if ok else "bad"
+                       for i, (ok, p) in enumerate(zip(accept.tolist(), percent.tolist()))]
+    
+    def covers(self, day):
+        """ Returns True if a day is in the window """
+        return self.first <= day < self.last
+    
+    def day_meals(self, day, category=None):
+        """ Returns a day's meals (only one category, if given) """
+        meals = self.meals.get(day, [])
+        if category is None:
+            return meals
+        return [meal for meal in meals if meal.category==category]
+
+def load_window(meal_plan, version, key):
+    """ Builds a PlanWindow on a worker thread, holding the plan's lock so edits can't interleave """
+    with meal_plan.lock:
+        return version, key, PlanWindow(meal_plan, *key)
+
 ############################################### Diet Model ######################################################
 # Where all the data is stored
 class DietModel(qtc.QAbstractItemModel):
     
     model_changed = qtc.pyqtSignal()
+    busy_changed = qtc.pyqtSignal(bool)
     
     def __init__(self):
         """ Constructs a Diet Model """
         super().__init__()
-        self.selected_scale = 7
+        self.selected_scale = 7 # #days, or 'month' / 'range' for the calendar grid
+        self.range_days = 14 # length of the 'range' view
         self.week_start_visible = True
-        self.meal_plan = diet.MealPlan()
+        self.meal_plan = diet.MealPlan(write_delay=0.5)
         self.calendar = qtw.QCalendarWidget()
         self.set_date(date.today())
         
+        # Plan edits run off the GUI thread, one at a time and in the order they were made
+        self.pool = qtc.QThreadPool()
+        self.pool.setMaxThreadCount(1)
+        self.tasks = []
+        
+        # Windows for the current view and its neighbors; the neighbors are prefetched in the background
+        self.windows = OrderedDict() # (start, n_days, grid) -> PlanWindow, least recently used first
+        self.plan_version = 0 # bumped when the plan changes, so stale prefetches are dropped
+        self.prefetch_pool = qtc.QThreadPool()
+        self.prefetch_pool.setMaxThreadCount(1)
+        self.prefetching = {} # (plan version, key) -> PlanTask still running
+        
+        # Recipe list for the sidebar
+        self.recipe_model = RecipeListModel(self)
+        
         self.calendar.selectionChanged.connect(self.model_changed.emit)
+        self.model_changed.connect(self.recipe_model.refresh)
+        # After the widgets have redrawn
+        self.model_changed.connect(lambda: qtc.QTimer.singleShot(0, self.prefetch))
     
     def set_scale(self, new_scale):
-        """ Sets the selected scale (#days) """
+        """ Sets the selected scale (#days, 'month' or 'range') """
         self.week_start_visible = new_scale==7
         self.selected_scale = new_scale
         self.model_changed.emit()
     
+    def set_range_days(self, n_days):
+        """ Sets the length of the custom range view """
+        self.range_days = n_days
+        if self.selected_scale=='range':
+            self.model_changed.emit()
+    
+    def is_grid(self):
+        """ Returns True if the scale is shown as a calendar grid rather than day boxes """
+        return self.selected_scale in ('month', 'range')
+    
+    def get_range(self, day=None):
+        """ Returns the first date and # of days shown at the current scale (from the selected date, or day) """
+        start = self.get_date() if day is None else day
+        if self.selected_scale=='month':
+            start = start.replace(day=1)
+            next_month = (start+timedelta(days=31)).replace(day=1)
+            return start, (next_month-start).days
+        elif self.selected_scale=='range':
+            return start, self.range_days
+        elif self.week_start_visible:
+            start = diet.find_week_start(start)
+        return start, self.selected_scale
+    
     def set_date(self, new_date):
         """ Sets the selected date """
         if type(new_date) is date:
@@ -109,22 +236,114 @@ class DietModel(qtc.QAbstractItemModel):
         d = date(qd.year(), qd.month(), qd.day())
         return d
     
+    def step_date(self, step):
+        """ Returns the selected date moved one page of the current scale forward (1) or back (-1) """
+        start, n_days = self.get_range()
+        if self.selected_scale=='month':
+            return start+timedelta(days=n_days) if step > 0 else (start-timedelta(days=1)).replace(day=1)
+        return self.get_date()+timedelta(days=step*n_days)
+    
     def increment_date(self):
         """ Increments the date by the # of days in scale """
-        td = timedelta(days = self.selected_scale)
-        self.set_date(self.get_date()+td)
+        self.set_date(self.step_date(1))
         
     def decrement_date(self):
         """ Decrements the date by the # of days in the scale """
-        td = timedelta(days = -self.selected_scale)
-        self.set_date(self.get_date()+td)
+        self.set_date(self.step_date(-1))
     
     def update_meal_plan(self):
-        """ Updates a meal in the meal plan """
-        self.meal_plan.to_file()
-        self.meal_plan.update()
+        """ Tells the widgets the meal plan changed (the plan saves its own edits) """
+        self.windows.clear()
+        self.plan_version += 1
         self.model_changed.emit()
     
+    def window_key(self, day=None):
+        """ Returns the window cache key for the current scale (from the selected date, or day) """
+        return (*self.get_range(day), self.is_grid())
+    
+    def get_window(self):
+        """ Returns the PlanWindow being shown, building it now if it wasn't prefetched """
+        key = self.window_key()
+        window = self.windows.get(key)
+        if window is None:
+            # Built under the lock so an edit on the worker thread can't change the plan halfway through
+            with self.meal_plan.lock:
+                window = PlanWindow(self.meal_plan, *key)
+            self.store_window(key, window)
+        else:
+            self.windows.move_to_end(key)
+        return window
+    
+    def day_meals(self, day, category):
+        """ Returns a day's meals in a category, from the window being shown if the day is in it """
+        window = self.get_window()
+        if window.covers(day):
+            return window.day_meals(day, category)
+        return self.meal_plan.get_meals(start=day, days=1, category=category)
+    
+    def store_window(self, key, window):
+        """ Adds a window to the cache, dropping the least recently used past window_cache_size """
+        self.windows[key] = window
+        self.windows.move_to_end(key)
+        while len(self.windows) > window_cache_size:
+            self.windows.popitem(last=False)
+    
+    def prefetch(self):
+        """ Builds the previous and next windows in the background, so paging to them is instant """
+        for step in (1, -1):
+            key = self.window_key(self.step_date(step))
+            pending = (self.plan_version, key)
+            if key in self.windows or pending in self.prefetching:
+                continue
+            task = PlanTask(load_window, self.meal_plan, self.plan_version, key)
+            task.setAutoDelete(False) # kept in self.prefetching until it reports back
+            task.signals.result.connect(self.window_loaded)
+            task.signals.failed.connect(self.prefetch_failed)
+            task.signals.finished.connect(lambda pending=pending: self.prefetching.pop(pending, None))
+            self.prefetching[pending] = task
+            self.prefetch_pool.start(task)
+    
+    def prefetch_failed(self, message):
+        """ Reports a window that couldn't be prefetched (it's built when shown instead) """
+        print("Could not prefetch meals:", message)
+    
+    def window_loaded(self, result):
+        """ Caches a prefetched window, unless the plan changed while it was being built """
+        version, key, window = result
+        if version==self.plan_version:
+            self.store_window(key, window)
+    
+    def run_task(self, func, *args):
+        """ Queues func(*args) on the worker thread; widgets update once the queue is empty """
+        task = PlanTask(func, *args)
+        task.setAutoDelete(False) # kept in self.tasks until it reports back
+        task.signals.failed.connect(self.task_failed)
+        task.signals.finished.connect(lambda: self.task_finished(task))
+        self.tasks.append(task)
+        if len(self.tasks)==1:
+            self.busy_changed.emit(True)
+        self.pool.start(task)
+    
+    def task_failed(self, message):
+        """ Reports an edit that couldn't be made """
+        print("Could not update the meal plan:", message)
+    
+    def task_finished(self, task):
+        """ Drops a finished task and refreshes the widgets when nothing else is queued """
+        self.tasks.remove(task)
+        if not self.tasks:
+            self.busy_changed.emit(False)
+            self.update_meal_plan()
+    
+    def is_busy(self):
+        """ Returns True while edits are queued or running """
+        return bool(self.tasks)
+    
+    def wait_for_tasks(self):
+        """ Blocks until every queued edit (and prefetch) has run """
+        self.pool.waitForDone()
+        self.prefetch_pool.waitForDone()
+    
 #     def add_meal(self, meal):
 #         """ Adds a recipe to the recipe list """
 #         self.meal_plan.add_meal(meal)
@@ -133,6 +352,196 @@ class DietModel(qtc.QAbstractItemModel):
 #     def remove_meal(self, meal):
 #         self.meal_plan.remove_meal(meal)
 
+### Recipe list model
+class RecipeListModel(qtc.QAbstractListModel):
+    
+    page_size = 100 # rows handed to the view per fetchMore
+    
+    def __init__(self, model):
+        """ Lists the meal plan's recipes, a page at a time as the view scrolls """
+        super().__init__()
+        self.model = model
+        self.query = "" # search box text; blank lists every recipe
+        self.recipes = list(model.meal_plan.recipes)
+        self.loaded = 0 # rows the view knows about
+    
+    def rowCount(self, parent=qtc.QModelIndex()):
+        return 0 if parent.isValid() else self.loaded
+    
+    def canFetchMore(self, parent=qtc.QModelIndex()):
+        return not parent.isValid() and self.loaded < len(self.recipes)
+    
+    def fetchMore(self, parent=qtc.QModelIndex()):
+        """ Adds the next page of recipes to the view """
+        if parent.isValid():
+            return
+        count = min(self.page_size, len(self.recipes)-self.loaded)
+        self.beginInsertRows(qtc.QModelIndex(), self.loaded, self.loaded+count-1)
+        self.loaded += count
+        self.endInsertRows()
+    
+    def data(self, index, role=qtc.Qt.DisplayRole):
+        if not index.isValid() or index.row() >= self.loaded:
+            return None
+        recipe = self.recipes[index.row()]
+        if role==qtc.Qt.DisplayRole:
+            return recipe.name
+        elif role==qtc.Qt.ToolTipRole:
+            return f"{recipe.percent:.0%} restricted"
+        elif role==qtc.Qt.UserRole:
+            return recipe
+        return None
+    
+    def recipe(self, index):
+        """ Returns the Recipe at a view index """
+        return self.recipes[index.row()]
+    
+    def refresh(self):
+        """ Re-reads the recipe list, keeping as many rows loaded as before """
+        self.beginResetModel()
+        self.recipes = self.model.meal_plan.search_recipes(self.query, limit=None)
+        self.loaded = min(max(self.loaded, self.page_size), len(self.recipes))
+        self.endResetModel()
+    
+    def set_query(self, query):
+        """ Shows only the recipes matching a search """
+        self.query = query
+        self.loaded = 0
+        self.refresh()
+
+class RecipeDelegate(qtw.QStyledItemDelegate):
+    
+    def paint(self, painter, option, index):
+        """ Paints a recipe row in its compliance color """
+        recipe = index.data(qtc.Qt.UserRole)
+        painter.save()
+        painter.fillRect(option.rect.adjusted(1, 1, -1, -1), status_colors[meal_status(recipe.percent)])
+        if option.state & qtw.QStyle.State_Selected:
+            painter.setPen(option.palette.highlight().color())
+            painter.drawRect(option.rect.adjusted(1, 1, -2, -2))
+        painter.setPen(qtg.QColor("black"))
+        painter.drawText(option.rect, qtc.Qt.AlignCenter, index.data(qtc.Qt.DisplayRole))
+        painter.restore()
+    
+    def sizeHint(self, option, index):
+        return qtc.QSize(50, 30)
+
+### Calendar grid model
+class CalendarModel(qtc.QAbstractTableModel):
+    
+    def __init__(self, model):
+        """ Lays out the days of the month or custom range as weeks (rows) by weekdays (columns) """
+        super().__init__()
+        self.model = model
+        self.start = date.today() # first day of the range
+        self.end = self.start # day after the range
+        self.grid_start = self.start # Monday of the first week shown
+        self.weeks = 0
+        self.meals = {} # date -> that day's meals
+        self.status = [] # grid day -> stylesheet status, or None for days without meals
+    
+    def rowCount(self, parent=qtc.QModelIndex()):
+        return 0 if parent.isValid() else self.weeks
+    
+    def columnCount(self, parent=qtc.QModelIndex()):
+        return 0 if parent.isValid() else 7
+    
+    def headerData(self, section, orientation, role=qtc.Qt.DisplayRole):
+        if role==qtc.Qt.DisplayRole and orientation==qtc.Qt.Horizontal:
+            return days[section]
+        return None
+    
+    def day(self, index):
+        """ Returns the date of a grid cell """
+        return self.grid_start+timedelta(days=index.row()*7+index.column())
+    
+    def data(self, index, role=qtc.Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        day = self.day(index)
+        if role==qtc.Qt.DisplayRole:
+            return str(day.day)
+        elif role==qtc.Qt.ToolTipRole:
+            return "\n".join(f"{meal.category.capitalize()}: {meal.name}" for meal in self.meals.get(day, []))
+        elif role==qtc.Qt.UserRole:
+            # Everything the delegate paints, in one lookup
+            return day, self.meals.get(day, []), self.start <= day < self.end, self.status[index.row()*7+index.column()]
+        return None
+    
+    def refresh(self):
+        """ Re-reads the meals and daily diet checks for the model's current range """
+        self.beginResetModel()
+        window = self.model.get_window()
+        self.start = window.start
+        self.end = window.start+timedelta(days=window.n_days)
+        self.grid_start = window.first
+        self.weeks = window.weeks
+        self.meals = window.meals
+        self.status = window.status
+        self.endResetModel()
+
+class CalendarDelegate(qtw.QStyledItemDelegate):
+    
+    def __init__(self, model, parent=None):
+        """ Paints a calendar day: its date on a strip in the day's status color, then a line per meal """
+        super().__init__(parent)
+        self.model = model
+    
+    def line_height(self, option):
+        return option.fontMetrics.height()+4
+    
+    def shown_meals(self, option, meals):
+        """ Returns the meals that fit in a cell (the last line says how many more there are if they don't) """
+        fits = max(0, option.rect.height()//self.line_height(option)-1)
+        return meals if len(meals) <= fits else meals[:max(0, fits-1)]
+    
+    def paint(self, painter, option, index):
+        """ Paints a day cell """
+        day, meals, in_range, status = index.data(qtc.Qt.UserRole)
+        rect = option.rect.adjusted(1, 1, -1, -1)
+        line = self.line_height(option)
+        painter.save()
+        if not in_range:
+            painter.fillRect(rect, option.palette.window()) # the view already paints the rest in the base color
+        # Date strip
+        strip = qtc.QRect(rect.left(), rect.top(), rect.width(), line)
+        if status is not None:
+            painter.fillRect(strip, status_colors[status])
+        painter.setPen(option.palette.text().color() if in_range else option.palette.mid().color())
+        label = f"{day.strftime('%b')} {day.day}" if day.day==1 else str(day.day)
+        painter.drawText(strip.adjusted(4, 0, -4, 0), qtc.Qt.AlignLeft | qtc.Qt.AlignVCenter, label)
+        # Meals
+        shown = self.shown_meals(option, meals)
+        painter.setPen(qtg.QColor("black"))
+        for i, meal in enumerate(shown):
+            row = qtc.QRect(rect.left()+2, rect.top()+line*(i+1), rect.width()-4, line-2)
+            painter.fillRect(row, status_colors[meal_status(meal.percent)])
+            text = option.fontMetrics.elidedText(meal.name, qtc.Qt.ElideRight, row.width()-6)
+            painter.drawText(row.adjusted(3, 0, -3, 0), qtc.Qt.AlignLeft | qtc.Qt.AlignVCenter, text)
+        if len(shown) < len(meals):
+            row = qtc.QRect(rect.left()+2, rect.top()+line*(len(shown)+1), rect.width()-4, line-2)
+            painter.setPen(option.palette.text().color())
+            painter.drawText(row.adjusted(3, 0, -3, 0), qtc.Qt.AlignLeft | qtc.Qt.AlignVCenter,
+                             f"+{len(meals)-len(shown)} more")
+        if option.state & qtw.QStyle.State_Selected:
+            painter.setPen(option.palette.highlight().color())
+            painter.drawRect(rect.adjusted(0, 0, -1, -1))
+        painter.restore()
+    
+    def sizeHint(self, option, index):
+        return qtc.QSize(100, self.line_height(option)*6)
+    
+    def editorEvent(self, event, model, option, index):
+        """ Opens the meal under a click """
+        if event.type()==qtc.QEvent.MouseButtonRelease and event.button()==qtc.Qt.LeftButton:
+            meals = self.shown_meals(option, index.data(qtc.Qt.UserRole)[1])
+            i = (event.pos().y()-option.rect.top()-1)//self.line_height(option)-1
+            if 0 <= i < len(meals):
+                self.meal_window = MealWindow(self.model, meal=meals[i])
+                self.meal_window.show()
+                return True
+        return super().editorEvent(event, model, option, index)
+
 ############################################## Sub-Widgets #####################################################
 
 class CategoryHeading(qtw.QFrame):
@@ -179,6 +588,10 @@ class CategoryHeading(qtw.QFrame):
         
         add_btn.pressed.connect(self.add_clicked)
     
+    def set_date(self, new_date):
+        """ Points the heading at another day """
+        self.date = new_date
+    
     def add_clicked(self):
         """ Opens the Add Meal window """
         self.add_window = AddWindow(self.model, self.date, self.category)
@@ -197,20 +610,15 @@ class MealBox(qtw.QPushButton):
         self.sizeHint = qtc.QSize(30, 20)
         self.model = model
         self.is_recipe = is_recipe
-        self.meal = meal
-        text = meal.name
-        self.setText(text)
         self.pressed.connect(self.on_recipe_click)
-        
-        badness = self.meal.percent
-        if badness>0.4:
-            self.setObjectName("bad")
-        elif badness > 0.2:
-            self.setObjectName("medium")
-        else:
-            self.setObjectName("good")
-
-        self.setStyleSheet(stylesheet)
+        self.set_meal(meal)
+    
+    def set_meal(self, meal):
+        """ Shows a meal (or recipe), only touching the text and status if they changed """
+        self.meal = meal
+        if self.text()!=meal.name:
+            self.setText(meal.name)
+        set_status(self, meal_status(meal.percent))
     
     def sizeHint(self):
         return qtc.QSize(50, 50) if self.is_recipe else qtc.QSize(100, 50)
@@ -225,11 +633,13 @@ class DayBox(qtw.QGroupBox):
     
     def __init__(self, box_date, model):
         ''' Constructor for a calendar day (holds meal data) '''
-        day = box_date.weekday()
-        super().__init__(f"{days[day]} {box_date.month}/{box_date.day}", alignment=qtc.Qt.AlignHCenter)
+        super().__init__(alignment=qtc.Qt.AlignHCenter)
         
-        self.date = box_date
+        self.date = None
         self.model = model
+        self.headings = {} # category -> CategoryHeading
+        self.meal_boxes = {} # category -> MealBoxes, reused as the day changes
+        self.category_layouts = {}
         
         # Layout
         self.layout = qtw.QVBoxLayout()
@@ -240,24 +650,42 @@ class DayBox(qtw.QGroupBox):
             qtw.QSizePolicy.MinimumExpanding
         )
         
+        # One heading and a column of meal boxes per category
+        for cat in diet.meal_categories:
+            cat_layout = qtw.QVBoxLayout()
+            self.layout.addLayout(cat_layout)
+            self.category_layouts[cat] = cat_layout
+            self.headings[cat] = CategoryHeading(self.model, box_date, cat)
+            cat_layout.addWidget(self.headings[cat])
+            self.meal_boxes[cat] = []
+        
         # Populate all meals for the day
+        self.set_date(box_date)
+    
+    def set_date(self, box_date):
+        """ Shows another day, reusing the existing widgets """
+        if box_date!=self.date:
+            self.date = box_date
+            self.setTitle(f"{days[box_date.weekday()]} {box_date.month}/{box_date.day}")
+            for heading in self.headings.values():
+                heading.set_date(box_date)
         self.populate_meals()
     
     def populate_meals(self):
-        """ Populates a day box with its meals """
-        meals = self.model.meal_plan.get_meals(start=self.date, days=1)
-        categories = {cat.capitalize()+":": [] for cat in diet.meal_categories}
-        for m in meals:
-            meal_box = MealBox(self.model, meal=m)
-            categories[m.category.capitalize()+":"].append(meal_box)
-        
-        for cat, meal_boxes in categories.items():
-            # Add category label
-            self.layout.addWidget(CategoryHeading(self.model, self.date, cat.lower()[:-1]))
-            
-            # Add meal boxes
-            for meal_box in meal_boxes:
-                self.layout.addWidget(meal_box)
+        """ Fills the day box with its meals, making new boxes only when a category has more meals than before """
+        for cat in diet.meal_categories:
+            meals = self.model.day_meals(self.date, cat)
+            boxes = self.meal_boxes[cat]
+            for i, m in enumerate(meals):
+                if i < len(boxes):
+                    boxes[i].set_meal(m)
+                    boxes[i].setVisible(True)
+                else:
+                    boxes.append(MealBox(self.model, meal=m))
+                    self.category_layouts[cat].addWidget(boxes[i])
+            # Spare boxes stay hidden until a later day needs them
+            for box in boxes[len(meals):]:
+                box.setVisible(False)
     
     def sizeHint(self):
         return qtc.QSize(100, 100)
@@ -276,11 +704,15 @@ class AddWindow(qtw.QWidget):
         layout = qtw.QFormLayout()
         self.setLayout(layout)
         
-        # Recipe choice
+        # Recipe search and choice
+        self.search_box = qtw.QLineEdit()
+        self.search_box.setPlaceholderText("Search recipes")
+        self.search_box.setClearButtonEnabled(True)
+        layout.addRow("Search:", self.search_box)
         self.recipe_choice = qtw.QComboBox()
-        for recipe in self.model.meal_plan.recipes:
-            self.recipe_choice.addItem(recipe.name, recipe.filename)
+        self.fill_recipes()
         layout.addRow("Recipe:", self.recipe_choice)
+        self.search_box.textChanged.connect(self.fill_recipes)
         
         # Date choice
         self.date_box = qtw.QDateEdit()
@@ -300,16 +732,24 @@ class AddWindow(qtw.QWidget):
         cancel_btn = qtw.QPushButton("Cancel", pressed=self.close)
         layout.addRow(save_btn, cancel_btn)
     
+    def fill_recipes(self, query=""):
+        """ Fills the recipe choice with the recipes matching the search box (the first few, if it's blank) """
+        self.recipe_choice.clear()
+        for recipe in self.model.meal_plan.search_recipes(query, search_limit):
+            self.recipe_choice.addItem(recipe.name, recipe.filename)
+    
     def save_clicked(self):
         """ Saves new meal to meal plan """
         filename = self.recipe_choice.currentData()
+        if filename is None: # nothing matched the search
+            return
         file = os.path.basename(filename)
         qdate = self.date_box.date()
         m_date = date(qdate.year(), qdate.month(), qdate.day())
         category = self.category_choice.currentText()
-        m = diet.Meal(file, m_date=m_date, category=category)
-        self.model.meal_plan.add_meal(m)
-        self.model.update_meal_plan()
+        m = diet.Meal(file, m_date=m_date, category=category, recipe_dir=self.model.meal_plan.recipe_dir,
+                      registry=self.model.meal_plan.registry)
+        self.model.run_task(self.model.meal_plan.add_meal, m)
         self.close()
         
 
@@ -432,15 +872,12 @@ class MealWindow(qtw.QWidget):
     
     def remove_clicked(self):
         """ Removes meal or recipe """
-        self.model.meal_plan.remove_meal(self.meal)
-        self.model.update_meal_plan()
+        self.model.run_task(self.model.meal_plan.remove_meal, self.meal)
         self.close()
     
     def save_clicked(self):
         """ Sends information to the model """
-        self.editable = False
-        self.set_entries()
-        self.populate_btns()
+        meal_plan = self.model.meal_plan
         
         # Check if a meal was passed
         if self.meal is None:
@@ -449,9 +886,13 @@ class MealWindow(qtw.QWidget):
                 print("Must enter a recipe name")
                 return
             file = recipe_filename(name)
-            self.meal = diet.Recipe(file)
+            self.meal = diet.Recipe(file, fields={}, recipe_dir=meal_plan.recipe_dir)
+        is_meal = type(self.meal) is diet.Meal
+        recipe = self.meal.recipe() if is_meal else self.meal
         
-        # Update fields
+        # Collect fields (they're applied on the worker thread, after any earlier edits)
+        changes = {}
+        new_date, new_category = None, None
         for label,widget in self.entries.items():
             # Check if it's a LineEdit or a TextEdit
             if type(widget) is qtw.QTextEdit:
@@ -460,16 +901,32 @@ class MealWindow(qtw.QWidget):
                 text = widget.text()
             # Process individual labels
             if label=="Date":
-                qdate = widget.date()
-                text = date(qdate.year(), qdate.month(), qdate.day())
+                new_date = from_qdate(widget.date())
+                continue
+            elif label=="Category":
+                new_category = text
+                continue
             elif label=="Ingredients":
-                text = widget.toPlainText()
                 text = ingr_to_dict(text)
-            setattr(self.meal, label.lower(), text)
+            changes[label.lower()] = text
+        
+        # Meals move to their new date/category as a new entry
+        new_meal = None
+        if is_meal:
+            try:
+                new_meal = diet.Meal(os.path.basename(recipe.filename), m_date=new_date, category=new_category,
+                                     recipe_dir=meal_plan.recipe_dir, registry=meal_plan.registry)
+            except ValueError as e:
+                print(e)
+                return
+        
+        self.editable = False
+        self.set_entries()
+        self.populate_btns()
         
         # Save new information
-        self.meal.to_file()
-        self.model.update_meal_plan()
+        old_meal = self.meal if is_meal else None
+        self.model.run_task(meal_plan.edit_recipe, recipe, changes, old_meal, new_meal)
         self.close()
 
 ############################################## Main Window Panels ##############################################
@@ -479,7 +936,7 @@ class MainDayPanel(qtw.QFrame):
     def __init__(self, model):
         """ Initializes the Main Day Panel (holds all day boxes) """
         super().__init__()
-        self.children = []
+        self.children = [] # DayBoxes, reused as the dates and scale change
         
         # Model
         self.model = model
@@ -494,35 +951,65 @@ class MainDayPanel(qtw.QFrame):
             qtw.QSizePolicy.MinimumExpanding
         )
         
+        # Month and custom range grid (painted by the delegate, so no widgets per day or meal)
+        self.calendar_model = CalendarModel(self.model)
+        self.calendar_view = qtw.QTableView()
+        self.calendar_view.setModel(self.calendar_model)
+        self.calendar_view.setItemDelegate(CalendarDelegate(self.model, self.calendar_view))
+        self.calendar_view.setSelectionMode(qtw.QAbstractItemView.SingleSelection)
+        self.calendar_view.horizontalHeader().setSectionResizeMode(qtw.QHeaderView.Stretch)
+        self.calendar_view.verticalHeader().setVisible(False)
+        self.calendar_view.setToolTip("Click a meal to open it, double-click a day to see just that day")
+        self.calendar_view.doubleClicked.connect(self.day_clicked)
+        self.calendar_view.setVisible(False)
+        self.layout.addWidget(self.calendar_view, 1)
+        
         self.read_model()
         
-    def clear_days(self):
-        """ Clears all child widgets from main panel """
-        for child in self.children:
-            child.close() # Works for some reason
-            self.layout.removeWidget(child)
-            child.destroy()
-        self.children = []
-    
     def populate_days(self):
-        """ Populates all days in the main day panel """
-        self.clear_days()
-        start = self.model.get_date()
-        scale = self.model.selected_scale
+        """ Populates all days in the main day panel, reusing the day boxes already there """
+        start, scale = self.model.get_range()
         
-        # Check for week view
-        if self.model.week_start_visible:
-            start = diet.find_week_start(start)
-        # Add days
+        # Update or add days
         for i in range(scale):
             td=timedelta(days=i)
-            day_box = DayBox(start+td, self.model)
-            self.layout.addWidget(day_box, 1)
-            self.children.append(day_box)
+            if i < len(self.children):
+                self.children[i].set_date(start+td)
+                self.children[i].setVisible(True)
+            else:
+                day_box = DayBox(start+td, self.model)
+                self.layout.addWidget(day_box, 1)
+                self.children.append(day_box)
+        # Hide days past the current scale
+        for day_box in self.children[scale:]:
+            day_box.setVisible(False)
+    
+    def populate_grid(self):
+        """ Shows the month or custom range in the calendar grid """
+        self.calendar_model.refresh()
+        # Months fill the panel; longer ranges scroll
+        rows = self.calendar_view.verticalHeader()
+        if self.calendar_model.weeks <= 6:
+            rows.setSectionResizeMode(qtw.QHeaderView.Stretch)
+        else:
+            rows.setSectionResizeMode(qtw.QHeaderView.Fixed)
+            rows.setDefaultSectionSize(self.calendar_view.fontMetrics().height()*8)
+    
+    def day_clicked(self, index):
+        """ Switches to the day view of a grid cell """
+        self.model.set_date(self.calendar_model.day(index))
+        self.model.set_scale(1)
     
     def read_model(self):
         """ Reads model data and updates widget """
-        self.populate_days()
+        grid = self.model.is_grid()
+        if grid:
+            for day_box in self.children:
+                day_box.setVisible(False)
+            self.populate_grid()
+        else:
+            self.populate_days()
+        self.calendar_view.setVisible(grid)
 
 ### Main title bar
 class MainTitleBar(qtw.QFrame):
@@ -553,17 +1040,27 @@ class MainTitleBar(qtw.QFrame):
         right_btn.setIcon(self.style().standardIcon(getattr(qtw.QStyle, "SP_ArrowForward")))
         
         # Combo Box
-        scale_choice = qtw.QComboBox()
-        scale_choice.addItem("day", 1)
-        scale_choice.addItem("4 days", 4)
-        scale_choice.addItem("week", 7)
-        scale_choice.setCurrentIndex(2)
+        self.scale_choice = qtw.QComboBox()
+        self.scale_choice.addItem("day", 1)
+        self.scale_choice.addItem("4 days", 4)
+        self.scale_choice.addItem("week", 7)
+        self.scale_choice.addItem("month", 'month')
+        self.scale_choice.addItem("range", 'range')
+        self.scale_choice.setCurrentIndex(2)
+        
+        # Length of the custom range (only shown for it)
+        self.range_days = qtw.QSpinBox()
+        self.range_days.setRange(1, 366)
+        self.range_days.setSuffix(" days")
+        self.range_days.setValue(self.model.range_days)
+        self.range_days.setVisible(False)
         
         # Add to Layout
         self.layout.addWidget(left_btn)
         self.layout.addWidget(self.page_title)
         self.layout.addWidget(right_btn)
-        self.layout.addWidget(scale_choice)
+        self.layout.addWidget(self.scale_choice)
+        self.layout.addWidget(self.range_days)
         
         # Indicator square
         self.layout.addWidget(qtw.QLabel("Diet status: "))
@@ -571,10 +1068,20 @@ class MainTitleBar(qtw.QFrame):
         self.indicator.setEnabled(False)
         self.layout.addWidget(self.indicator)
         
+        # Busy bar (shown while edits are saving)
+        self.busy = qtw.QProgressBar()
+        self.busy.setRange(0, 0)
+        self.busy.setMaximumWidth(80)
+        self.busy.setToolTip("Saving changes")
+        self.busy.setVisible(False)
+        self.layout.addWidget(self.busy)
+        
         # Connect to model
         left_btn.pressed.connect(self.model.decrement_date)
         right_btn.pressed.connect(self.model.increment_date)
-        scale_choice.currentIndexChanged.connect(lambda: self.model.set_scale(scale_choice.currentData()))
+        self.scale_choice.currentIndexChanged.connect(lambda: self.model.set_scale(self.scale_choice.currentData()))
+        self.range_days.valueChanged.connect(self.model.set_range_days)
+        self.model.busy_changed.connect(self.busy.setVisible)
         
         self.read_model()
     
@@ -587,22 +1094,26 @@ class MainTitleBar(qtw.QFrame):
     
     def set_indicator(self):
         """ Checks diet and sets indicator bar """
-        start = self.model.get_date()
-        scale = self.model.selected_scale
         # Check diet
-        accept, percent = self.model.meal_plan.check_plan(start, scale)
+        accept = self.model.get_window().accept
         if accept:
-            self.indicator.setObjectName("good")
+            set_status(self.indicator, "good")
             self.indicator.setText("Good Job!")
         else:
-            self.indicator.setObjectName("bad")
+            set_status(self.indicator, "bad")
             self.indicator.setText("Make changes")
-        self.indicator.setStyleSheet(stylesheet)
     
     def read_model(self):
         """ Reads model data and updates widget """
         title = self.model.get_date().strftime("%B %Y")
         self.set_title(title)
+        # The scale can also change from the calendar grid (double-clicking a day)
+        index = self.scale_choice.findData(self.model.selected_scale)
+        if index!=self.scale_choice.currentIndex():
+            self.scale_choice.blockSignals(True)
+            self.scale_choice.setCurrentIndex(index)
+            self.scale_choice.blockSignals(False)
+        self.range_days.setVisible(self.model.selected_scale=='range')
         self.set_indicator()
 
 ### Main Side Bar
@@ -612,11 +1123,8 @@ class MainSideBar(qtw.QFrame):
         """ Constructor for the Main Side Bar """
         super().__init__()
         
-        self.recipe_widgets = []
-        
         # Model
         self.model = model
-        self.model.model_changed.connect(self.read_model)
         
         # Layout
         self.layout = qtw.QVBoxLayout()
@@ -646,19 +1154,26 @@ class MainSideBar(qtw.QFrame):
         )
         self.layout.addWidget(recipe_label)
         
-        # Recipe List
-        self.recipe_list = qtw.QFrame()
-        self.recipe_list.setFrameStyle(qtw.QFrame.StyledPanel)
+        # Search box
+        self.search_box = qtw.QLineEdit()
+        self.search_box.setPlaceholderText("Search recipes")
+        self.search_box.setClearButtonEnabled(True)
+        self.search_box.textChanged.connect(self.model.recipe_model.set_query)
+        self.layout.addWidget(self.search_box)
+        
+        # Recipe List (rows are painted by the delegate, so no widget per recipe)
+        self.recipe_list = qtw.QListView()
+        self.recipe_list.setModel(self.model.recipe_model)
+        self.recipe_list.setItemDelegate(RecipeDelegate(self.recipe_list))
+        self.recipe_list.setUniformItemSizes(True)
+        self.recipe_list.setSpacing(4)
         self.recipe_list.setSizePolicy(
             qtw.QSizePolicy.Expanding,
             qtw.QSizePolicy.MinimumExpanding
         )
-        self.recipe_list.setLayout(qtw.QVBoxLayout())
-        self.recipe_list.layout().setAlignment(qtc.Qt.AlignTop)
-        self.recipe_list.layout().setSpacing(20)
         self.recipe_list.sizeHint = lambda: qtc.QSize(50, 50)
+        self.recipe_list.clicked.connect(self.recipe_clicked)
         self.layout.addWidget(self.recipe_list)
-        self.populate_recipe_list()
         
         # Add Button
         btn_layout = qtw.QHBoxLayout()
@@ -673,8 +1188,6 @@ class MainSideBar(qtw.QFrame):
             qtw.QSizePolicy.Fixed
         )
         btn_layout.addWidget(self.add_btn)
-        
-        self.read_model()
     
     def sizeHint(self):
         return qtc.QSize(150, 150)
@@ -683,17 +1196,11 @@ class MainSideBar(qtw.QFrame):
         self.add_window = MealWindow(self.model, is_recipe=True)
         self.add_window.show()
     
-    def populate_recipe_list(self):
-        """ Populates the sidebar recipe list """
-        clear_widget(self.recipe_list, self.recipe_widgets)
-        for recipe in self.model.meal_plan.recipes:
-            recipe_widget = MealBox(self.model, meal=recipe, is_recipe=True)
-            self.recipe_list.layout().addWidget(recipe_widget)
-            self.recipe_widgets.append(recipe_widget)
-    
-    def read_model(self):
-        """ Reads model and updates widget """
-        self.populate_recipe_list()
+    def recipe_clicked(self, index):
+        """ Opens a recipe from the list """
+        recipe = self.model.recipe_model.recipe(index)
+        self.meal_window = MealWindow(self.model, meal=recipe, is_recipe=True)
+        self.meal_window.show()
 
 ### Main Window
 class MainWindow(qtw.QWidget):
@@ -731,9 +1238,11 @@ class MainWindow(qtw.QWidget):
 if __name__ == '__main__':
     # Start application wity system arguments
     app = qtw.QApplication(sys.argv)
+    app.setStyleSheet(stylesheet)
     mw = MainWindow()
     mw.show()
     # Exit with app code upon closing the window
     code = app.exec()
+    mw.model.wait_for_tasks()
     mw.model.meal_plan.to_file()
     sys.exit(code)
\ No newline at end of file
@@ -1,14 +1,23 @@
 ### diet_planner.py - Contains methods and functions for mom's diet app
 
 import numpy as np
-import pandas as pd
-from datetime import date, time, timedelta, datetime
-import pint
-import sys
+from datetime import date, timedelta
 import os
 import glob
 import io
 import re
+import bisect
+import csv
+import sqlite3
+import pickle
+import functools
+import importlib
+import contextlib
+import tempfile
+import threading
+import itertools
+import operator
+import concurrent.futures
 
 food_categories = ['dairy', 'processed', 'grain', 'fruit']
 meal_categories = ['breakfast', 'lunch', 'dinner', 'snack']
@@ -30,67 +39,215 @@ defaults = {
     'category': 'snack'
 }
 
+restricted_limit = 0.2 # largest compliant fraction of restricted food
+
 saved_diet = 'tracker.csv'
 saved_recipes = 'Recipes/'
 saved_meals = 'saved_meals.csv'
+saved_snapshot = '.plan_snapshot' # suffix of the snapshot kept beside the meal file
+snapshot_version = 1 # bump when the snapshot layout changes
+
+gram_factors = {} # Unit -> grams in one of that unit, filled in as units are first used
 
-units = pint.UnitRegistry()
+### Lazy Imports
+# pandas and pint are slow to import, so they (and the unit registry) load on first use
+@functools.lru_cache(maxsize=None)
+def get_units():
+    """ Returns the shared pint UnitRegistry, building it with the kitchen context the first time """
+    import pint
+    units = pint.UnitRegistry()
+    
+    # Add context to convert volume to weight/mass and vice versa
+    density = (8*units.oz).to_base_units()/(1*units.cup).to_base_units()
+    ctx = pint.Context('kitchen')
+    ctx.add_transformation('[volume]', '[mass]',
+                         lambda units, x: x.to_base_units()*density)
+    ctx.add_transformation('[mass]', '[volume]',
+                         lambda units, x: x.to_base_units()/density)
+    units.add_context(ctx)
+    units.enable_contexts('kitchen')
+    return units
 
-# Add context to convert volume to weight/mass and vice versa
-density = (8*units.oz).to_base_units()/(1*units.cup).to_base_units()
-ctx = pint.Context('kitchen')
-ctx.add_transformation('[volume]', '[mass]',
-                     lambda units, x: x.to_base_units()*density)
-ctx.add_transformation('[mass]', '[volume]',
-                     lambda units, x: x.to_base_units()/density)
-units.add_context(ctx)
-units.enable_contexts('kitchen')
+lazy_attributes = {
+    'units': get_units,
+    'measure_unit': lambda: get_units().g,
+    'pint': lambda: importlib.import_module('pint'),
+    'pd': lambda: importlib.import_module('pandas'),
+}
 
-measure_unit = units.g
+def __getattr__(name):
+    """ Loads diet.units, diet.measure_unit, diet.pint and diet.pd the first time they are used """
+    if name in lazy_attributes:
+        value = lazy_attributes[name]()
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 def dict_to_pandas(foods):
     """ Converts a food:amount dictionary to a pandas dataframe """
+    import pandas as pd
     data = [[value.magnitude, value.units, key] for key, value in foods.items()]
     df = pd.DataFrame(data, columns=ingredient_columns)
     return df
 
+@functools.lru_cache(maxsize=256)
+def parse_unit(name):
+    """ Returns the pint Unit for a unit string, parsing each distinct string only once """
+    return get_units().Unit(name.strip())
+
+def grams_per_unit(unit):
+    """ Returns the grams in one of unit, adding it to the table if it's new """
+    factor = gram_factors.get(unit)
+    if factor is None:
+        factor = (1*unit).to(get_units().g).magnitude
+        gram_factors[unit] = factor
+    return factor
+
+@functools.lru_cache(maxsize=256)
+def unit_grams(name):
+    """ Returns the grams in one of a unit given by name """
+    return grams_per_unit(parse_unit(name))
+
+def to_grams(quantity):
+    """ Converts a pint Quantity to a float number of grams """
+    return quantity.magnitude*grams_per_unit(quantity.units)
+
 def calc_foods(meals):
-    """ Sum of food amounts for list of meals """
+    """ Sum of food amounts (in grams) for list of meals """
     foods = {}
     for meal in meals:
         # Add up foods
-        for food_name in meal.ingredients:
-            if food_name in foods:
-                u = foods[food_name].units
-                foods[food_name] += meal.ingredients[food_name].to(u)
-            else:
-                foods[food_name] = meal.ingredients[food_name]
+        for food_name, grams in meal.grams().items():
+            foods[food_name] = foods.get(food_name, 0)+grams
     
     return foods
 
+@functools.lru_cache(maxsize=4096)
+def normalize_food(name):
+    """ Lower-cases a food name, collapses whitespace and makes the last word singular """
+    words = name.lower().split()
+    if words:
+        words[-1] = singular(words[-1])
+    return " ".join(words)
+
+def singular(word):
+    """
+    Drops simple English plural endings (berries, tomatoes, peaches, carrots)
+    -ies can't tell berry from cookie, so singular -ie words share the -y form (cookie, cookies -> cooky)
+    -es can't tell peach from quiche, so singular -che/-she/-xe/-ze/-oe words drop their e (quiche, quiches -> quich)
+    """
+    if len(word) > 4 and word.endswith('ies'):
+        return word[:-3]+'y'
+    if len(word) > 4 and word.endswith('ie'):
+        return word[:-2]+'y'
+    if len(word) > 4 and word.endswith(('ches', 'shes', 'xes', 'zes', 'oes')):
+        return word[:-2]
+    if len(word) > 3 and word.endswith(('che', 'she', 'xe', 'ze', 'oe')):
+        return word[:-1]
+    if len(word) > 3 and word.endswith('s') and not word.endswith(('ss', 'us', 'is')):
+        return word[:-1]
+    return word
+
+### Diet Index
+class DietIndex:
+    
+    def __init__(self, diet={}):
+        """ Maps normalized food names to their diet class (allowed, restricted or banned) """
+        self.classes = {}
+        # Later columns win, so a food listed twice gets its strictest class
+        for category in diet_columns:
+            for food in diet.get(category, []):
+                self.classes[normalize_food(food)] = category
+    
+    def __len__(self):
+        return len(self.classes)
+    
+    def __contains__(self, food):
+        return normalize_food(food) in self.classes
+    
+    def classify(self, food):
+        """ Returns the diet class of a food (anything not listed is allowed) """
+        return self.classes.get(normalize_food(food), 'allowed')
+    
+    def add(self, food, category):
+        """ Lists a food under a category, unless it's already in a stricter one """
+        name = normalize_food(food)
+        current = self.classes.get(name)
+        if current is None or diet_columns.index(category) >= diet_columns.index(current):
+            self.classes[name] = category
+    
+    def remove(self, food):
+        """ Unlists a food """
+        self.classes.pop(normalize_food(food), None)
+
 def check_foods(foods, diet):
     """
-    Checks the dictionary of foods passed in for diet compliance
+    Checks the dictionary of foods (in grams) passed in for diet compliance
+    diet can be a DietIndex or a dictionary of food lists
     Returns whether the food is diet compliant, followed by the percentage of restricted foods
     """
-    restricted_tally = 0 * measure_unit # common units
-    other_tally = 0 * measure_unit
+    if not isinstance(diet, DietIndex):
+        diet = DietIndex(diet)
+    restricted_tally = 0 # grams
+    other_tally = 0
     allowed = True
     for food_name in foods:
-        if food_name in diet['banned']:
+        category = diet.classify(food_name)
+        if category=='banned':
             allowed = False
-            restricted_tally += foods[food_name].to(measure_unit)
-        elif food_name in diet['restricted']:
-            restricted_tally += foods[food_name].to(measure_unit) # add amt to counter
+            restricted_tally += foods[food_name]
+        elif category=='restricted':
+            restricted_tally += foods[food_name] # add amt to counter
         else: # for now, just assume everything not listed is fine
-            other_tally += foods[food_name].to(measure_unit)
+            other_tally += foods[food_name]
 
     # No restricted foods
     if restricted_tally == 0:
         return allowed, 0
 
-    restricted_amt = (restricted_tally/(restricted_tally+other_tally)).magnitude
-    return restricted_amt <= 0.2, restricted_amt
+    restricted_amt = restricted_tally/(restricted_tally+other_tally)
+    return restricted_amt <= restricted_limit, restricted_amt
+
+def meal_key(meal):
+    """ Returns the (filename, date, category) key identifying a meal """
+    return (meal.base_recipe.basename, meal.date, meal.category)
+
+def meal_row(key):
+    """ Returns the saved row (filename, iso date, category) for a meal key """
+    filename, m_date, category = key
+    return [filename, m_date.isoformat(), category]
+
+@functools.lru_cache(maxsize=1)
+def new_file_mode():
+    """ Returns the mode open() gives new files (0o666 less the umask) """
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+def atomic_write(path, text):
+    """ Writes a file (text or bytes) through a temp file renamed over it, so readers never see half a file """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".tmp_")
+    try:
+        # mkstemp makes the file 0600, so give it the old file's mode (or a new file's)
+        try:
+            mode = os.stat(path).st_mode & 0o7777
+        except FileNotFoundError:
+            mode = new_file_mode()
+        os.chmod(tmp, mode)
+        with (os.fdopen(fd, 'wb') if type(text) is bytes else os.fdopen(fd, 'w', newline='')) as f:
+            f.write(text)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+def file_stamp(path):
+    """ Returns a file's (mtime in ns, size), or None if it doesn't exist """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
 
 def find_week_start(d=date.today(), week='this'):
     ''' Finds the first day of the given week as a date object '''
@@ -103,6 +260,76 @@ def find_week_start(d=date.today(), week='this'):
     else:
         raise ValueError("Invalid week string")
 
+def read_recipe_file(path):
+    """
+    Parses a recipe file into a dictionary of Recipe fields
+    Ingredients are returned as [quantity, units, food] rows so the result can be pickled
+    """
+    with open(path, 'r') as f:
+        filestring = f.read()
+    return parse_recipe(filestring)
+
+def parse_recipe(filestring):
+    """ Parses the text of a recipe file in one pass over its labels """
+    fields = {}
+    labels = list(recipe_labels.items())
+    # Find each label in order, starting after the previous one
+    starts = []
+    cursor = 0
+    for var, label in labels:
+        pos = filestring.find(label, cursor)
+        if pos==-1:
+            starts.append(None)
+            continue
+        starts.append(pos)
+        cursor = pos+len(label)
+    
+    for i, (var, label) in enumerate(labels):
+        if starts[i] is None:
+            fields[var] = defaults[var]
+            continue
+        # Value runs up to the next label that was found
+        end = next((pos for pos in starts[i+1:] if pos is not None), len(filestring))
+        value = filestring[starts[i]+len(label):end]
+        if value=="":
+            fields[var] = defaults[var]
+        elif var=='servings':
+            fields[var] = float(value)
+        elif var=='ingredients':
+            fields[var] = parse_ingredients(value)
+        else:
+            fields[var] = value
+    return fields
+
+def parse_ingredients(text):
+    """ Parses quantity,units,food lines into [quantity, units, food] rows """
+    rows = []
+    for line in text.split("\n"):
+        if line=="" or line.isspace():
+            continue
+        if '"' in line: # quoted food name
+            quantity, unit, food = next(csv.reader([line]))
+        else:
+            quantity, unit, food = line.split(",", 2)
+        rows.append([float(quantity), unit, food])
+    return rows
+
+def format_recipe(fields):
+    """ Returns the text of a recipe file from a dictionary of Recipe fields """
+    filestring = ""
+    for var,label in recipe_labels.items():
+        filestring += label
+        value = fields.get(var, defaults[var])
+        # Ingredients to csv format
+        if var=='ingredients':
+            s = io.StringIO()
+            csv.writer(s, lineterminator="\n").writerows(value)
+            value = s.getvalue()[:-1] # Take off extra \n
+        elif var=='servings' and isinstance(value, float):
+            value = f"{value:g}" # 2.0 -> 2
+        filestring += str(value)
+    return filestring
+
 ### Food class
 class Food:
     def __init__(self, name, category, special=None):
@@ -119,9 +346,11 @@ class Food:
 ### Recipe class
 class Recipe:
     
-    def __init__(self, filename, name="", servings=0, ingredients={}, instructions="", recipe_dir=saved_recipes):
-        """ Constructor for the Recipe class """
+    def __init__(self, filename, name="", servings=0, ingredients={}, instructions="", recipe_dir=saved_recipes,
+                 fields=None):
+        """ Constructor for the Recipe class (fields skips reading the file) """
         self.filename = recipe_dir+filename
+        self.basename = os.path.basename(self.filename)
         self.name = name
         self.ingredients = ingredients
         self.instructions = instructions
@@ -129,10 +358,46 @@ class Recipe:
         self.percent = 0
         self.accept = True
         
-        if os.path.exists(self.filename):
+        if fields is not None:
+            self.set_fields(fields)
+        elif os.path.exists(self.filename):
             self.set_file()
         else:
             self.to_file()
+        self.dirty = False
+    
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        if name in recipe_labels: # a saved field changed
+            super().__setattr__('dirty', True)
+    
+    @property
+    def ingredients(self):
+        if self._ingredients is None:
+            # Loaded recipes keep their raw rows until something needs the Quantities
+            self._ingredients = {food.lower(): get_units().Quantity(quantity, parse_unit(unit))
+                                 for quantity, unit, food in self._rows}
+        return self._ingredients
+    
+    @ingredients.setter
+    def ingredients(self, value):
+        self._ingredients = value
+        self._rows = None
+        self._grams = None # recompute on next grams() call
+    
+    def set_rows(self, rows):
+        """ Sets the ingredients from [quantity, unit, food] rows without building Quantities yet """
+        self.ingredients = None
+        self._rows = rows
+    
+    def grams(self):
+        """ Returns a food:grams dictionary for the recipe's ingredients """
+        if self._grams is None:
+            if self._ingredients is None:
+                self._grams = {food.lower(): quantity*unit_grams(unit) for quantity, unit, food in self._rows}
+            else:
+                self._grams = {food: to_grams(amount) for food, amount in self._ingredients.items()}
+        return self._grams
     
     def __str__(self):
         return f"Recipe: {self.name}"
@@ -144,79 +409,420 @@ class Recipe:
         return str(self)
     
     def __hash__(self):
-        return len(self.name) % 31 + len(self.ingredients) % 31 + self.servings*31 % 7
+        return hash(self.filename)
     
     def to_file(self):
         """ Saves a Recipe object to file """
-        filestring = ""
-        # Loop through attributes
-        for var,label in recipe_labels.items():
-            filestring += label
-            attr = getattr(self, var)
-            
-            # Ingredients to csv format
-            if var=='ingredients':
-                df = dict_to_pandas(attr)
-                s = io.StringIO()
-                df.to_csv(s, index=False, header=False)
-                attr = s.getvalue()
-                attr = attr[:-1] # Take off extra \n
-            
-            filestring += str(attr)
-        
-        # Write file
-        f = open(self.filename, 'w')
-        f.write(filestring)
-        f.close()
+        atomic_write(self.filename, format_recipe(self.fields()))
+        self.dirty = False
+    
+    def fields(self):
+        """ Returns the recipe's options in the form read_recipe_file returns them """
+        if self._ingredients is None:
+            ingredients = [list(row) for row in self._rows]
+        else:
+            ingredients = [[amount.magnitude, str(amount.units), food] for food, amount in self._ingredients.items()]
+        return {'name': self.name, 'servings': self.servings, 'ingredients': ingredients,
+                'instructions': self.instructions}
     
     def set_file(self):
         """ Sets a recipe's options to match a filename """
-        with open(self.filename, 'r') as f:
-            filestring = f.read()
-        
-        # Filter relevant values of file
-        regex = "("+"|".join(recipe_labels.values())+")"
-        file_list = re.split(regex, filestring)
-        file_list = list(filter(None, file_list)) # get rid of '' @ beginning
-        
-        # Process values
-        for var,label in recipe_labels.items():
-            # Get value of variable
-            if file_list.index(label)+1==len(file_list) or file_list[file_list.index(label)+1] in recipe_labels.values():
-                setattr(self, var, defaults[var])
-                continue
-            value = file_list[file_list.index(label)+1]
-            # Parse servings
-            if var=='servings':
-                value = float(value)
-                continue
-            # Parse ingredients
+        self.set_fields(read_recipe_file(self.filename))
+    
+    def set_fields(self, fields):
+        """ Sets a recipe's options from the fields returned by read_recipe_file """
+        for var, value in fields.items():
             if var=='ingredients':
-                s = io.StringIO(value)
-                data = pd.read_csv(s, header=None, names=ingredient_columns)
-                value = {}
-                for i in range(len(data.food)):
-                    value[data.food[i].lower()] = data.quantity[i]*units(data.units[i])
-            
-            # Set class variable
-            setattr(self, var, value)
+                self.set_rows(value)
+            else:
+                setattr(self, var, value)
+        self.dirty = False # matches what was read
     
     @staticmethod
-    def from_file(filename):
+    def from_file(filename, recipe_dir=saved_recipes):
         """ Returns a new Recipe with options from filename """
-        r = Recipe(filename)
+        r = Recipe(filename, recipe_dir=recipe_dir)
         return r
         
+### Recipe Registry
+class RecipeRegistry:
+    
+    def __init__(self):
+        """ Holds one parsed Recipe per file, shared by every meal that uses it (each MealPlan has its own) """
+        self.recipes = {} # full path -> Recipe
+    
+    def __contains__(self, path):
+        return path in self.recipes
+    
+    def get(self, filename, recipe_dir=saved_recipes):
+        """ Returns the shared Recipe for a file, parsing it only the first time """
+        path = recipe_dir+filename
+        recipe = self.recipes.get(path)
+        if recipe is None:
+            recipe = Recipe.from_file(filename, recipe_dir)
+            self.recipes[path] = recipe
+        return recipe
+    
+    def load(self, filename, recipe_dir=saved_recipes, fields=None):
+        """
+        Re-reads a recipe from file (or from already parsed fields),
+        keeping the shared object if there is one
+        """
+        path = recipe_dir+filename
+        recipe = self.recipes.get(path)
+        if recipe is None and fields is None:
+            return self.get(filename, recipe_dir)
+        if recipe is None:
+            recipe = Recipe(filename, recipe_dir=recipe_dir, fields=fields)
+            self.recipes[path] = recipe
+        elif fields is None:
+            recipe.set_file()
+        else:
+            recipe.set_fields(fields)
+        return recipe
+    
+    def add(self, recipe):
+        """ Registers a Recipe object under its filename """
+        self.recipes[recipe.filename] = recipe
+    
+    def remove(self, recipe):
+        """ Forgets a recipe """
+        self.recipes.pop(recipe.filename, None)
+    
+    def clear(self):
+        """ Forgets all recipes """
+        self.recipes = {}
+
+recipe_registry = RecipeRegistry()
+
+### Recipe Search
+def search_tokens(text):
+    """ Splits text into lower-case words for the search index """
+    return re.findall(r"[a-z0-9]+", str(text).lower())
+
+def search_text(recipe):
+    """ Returns the text a recipe is searched by: its name, foods and instructions """
+    return " ".join([recipe.name, *recipe.grams(), recipe.instructions])
+
+class RecipeSearch:
+    bitmap_min = 1024 # recipes a word or short prefix needs before it keeps a bitmap
+    
+    def __init__(self, recipes=[]):
+        """
+        Inverted index from the words in recipe names, ingredients and instructions to the recipes
+        Each recipe also gets a slot (its position in index order). Common words and common one- or
+        two-letter prefixes keep a bitmap over the slots, so queries made only of common words are intersected
+        with a few NumPy ANDs instead of recipe by recipe
+        """
+        self.postings = {} # word -> {recipe filename: Recipe}, in the order recipes were added
+        self.recipe_words = {} # recipe filename -> its words, each after a space (" apple pie"), for prefix checks
+        self.recipes = {} # recipe filename -> Recipe
+        self.texts = {} # recipe filename -> the search_text it was indexed from
+        self.slots = {} # recipe filename -> slot
+        self.slot_files = [] # slot -> recipe filename (None once the recipe is removed or re-indexed)
+        self.word_bits = {} # common word -> packed bitmap of the slots whose recipe has it
+        self.prefix_bits = {} # common one- or two-letter prefix -> packed bitmap of the slots with a word starting with it
+        self.prefix_counts = {} # other one- or two-letter prefixes -> how many recipes have a word starting with it
+        self.capacity = 0 # bytes in each bitmap
+        for recipe in recipes:
+            self.index(recipe)
+        self.words = sorted(self.postings) # every indexed word, for prefix lookups
+        self.build_bitmaps()
+    
+    def __len__(self):
+        return len(self.recipe_words)
+    
+    def index(self, recipe):
+        """ Adds a recipe's words to the postings, returning the words that are new to the index """
+        text = search_text(recipe)
+        words = set(search_tokens(text))
+        new = []
+        for word in words:
+            posting = self.postings.get(word)
+            if posting is None:
+                posting = self.postings[word] = {}
+                new.append(word)
+            posting[recipe.filename] = recipe
+        self.recipe_words[recipe.filename] = "".join(" "+word for word in sorted(words))
+        self.recipes[recipe.filename] = recipe
+        self.texts[recipe.filename] = text
+        self.slots[recipe.filename] = len(self.slot_files)
+        self.slot_files.append(recipe.filename)
+        return new
+    
+    def add(self, recipe):
+        """ Indexes a recipe, replacing what was indexed for it before """
+        self.remove(recipe)
+        for word in self.index(recipe):
+            bisect.insort(self.words, word)
+        if len(self.slot_files) > 2*len(self.slots)+self.bitmap_min:
+            self.build_bitmaps() # mostly re-indexed slots: renumber them
+        else:
+            self.mark(recipe.filename)
+    
+    def remove(self, recipe):
+        """ Drops a recipe from the index """
+        filename = recipe.filename
+        words = self.recipe_words.pop(filename, "").split()
+        if not words:
+            return
+        self.recipes.pop(filename)
+        self.texts.pop(filename)
+        slot = self.slots.pop(filename)
+        self.slot_files[slot] = None
+        byte, bit = slot >> 3, np.uint8(~(1 << (slot & 7)) & 0xff)
+        for word in words:
+            posting = self.postings[word]
+            del posting[filename]
+            if not posting:
+                del self.postings[word]
+                del self.words[bisect.bisect_left(self.words, word)]
+            bits = self.word_bits.get(word)
+            if bits is not None:
+                bits[byte] &= bit
+                if not posting:
+                    del self.word_bits[word]
+        for prefix in self.short_prefixes(words):
+            bits = self.prefix_bits.get(prefix)
+            if bits is not None:
+                bits[byte] &= bit
+            else:
+                self.prefix_counts[prefix] -= 1
+                if not self.prefix_counts[prefix]:
+                    del self.prefix_counts[prefix]
+    
+    def sync(self, recipes):
+        """ Brings the index in line with a recipe list, re-indexing only recipes that were added or changed """
+        current = {recipe.filename for recipe in recipes}
+        for filename in [filename for filename in self.recipes if filename not in current]:
+            self.remove(self.recipes[filename])
+        new, changed = [], []
+        for recipe in recipes:
+            if self.recipes.get(recipe.filename) is not recipe or self.texts[recipe.filename]!=search_text(recipe):
+                self.remove(recipe)
+                new += self.index(recipe)
+                changed.append(recipe.filename)
+        # A few new words are inserted in place; many (e.g. the first sync) are cheaper to sort in one go
+        if len(new) > 64:
+            self.words = sorted(self.postings)
+        else:
+            for word in new:
+                bisect.insort(self.words, word)
+        # Changed recipes are marked in the bitmaps one by one, unless so many changed that rebuilding is cheaper
+        if len(changed) > len(self.slots)//8 or len(self.slot_files) > 2*len(self.slots)+self.bitmap_min:
+            self.build_bitmaps()
+        else:
+            for filename in changed:
+                self.mark(filename)
+    
+    def short_prefixes(self, words):
+        """ Returns the one- and two-letter prefixes of some words """
+        return {word[:1] for word in words} | {word[:2] for word in words if len(word) > 1}
+    
+    def slot_array(self, postings):
+        """ Returns the slots of the recipes in some postings """
+        filenames = list(itertools.chain.from_iterable(postings))
+        return np.fromiter(map(self.slots.__getitem__, filenames), dtype=np.int64, count=len(filenames))
+    
+    def bitmap(self, slots):
+        """ Returns a packed bitmap (self.capacity bytes) with the given slots set """
+        bits = np.zeros(8*self.capacity, dtype=bool)
+        bits[slots] = True
+        return np.packbits(bits, bitorder='little')
+    
+    def build_bitmaps(self):
+        """ Renumbers the slots in index order and rebuilds every bitmap from the postings """
+        self.slot_files = [filename for filename in self.slot_files if filename is not None]
+        self.slots = dict(zip(self.slot_files, range(len(self.slot_files))))
+        self.capacity = (len(self.slot_files)+len(self.slot_files)//4)//8+64 # room for some more recipes
+        # Every posting's slots, word by word in sorted order, so each word and each prefix is a run of the array
+        postings = [self.postings[word] for word in self.words]
+        ends = np.cumsum(np.fromiter(map(len, postings), dtype=np.int64, count=len(postings))).tolist()
+        starts = [0]+ends[:-1]
+        slots = self.slot_array(postings)
+        self.word_bits = {word: self.bitmap(slots[lo:hi]) for word, lo, hi in zip(self.words, starts, ends)
+                          if hi-lo >= self.bitmap_min}
+        self.prefix_bits, self.prefix_counts = {}, {}
+        for length in (1, 2):
+            runs = itertools.groupby(range(len(self.words)), lambda i: self.words[i][:length])
+            for prefix, run in runs:
+                if len(prefix) < length:
+                    continue # a one-letter word among the two-letter prefixes
+                first = last = next(run)
+                for last in run:
+                    pass
+                run_slots = slots[starts[first]:ends[last]]
+                if len(run_slots) >= self.bitmap_min:
+                    bits = self.bitmap(run_slots)
+                    count = int(np.count_nonzero(np.unpackbits(bits)))
+                else:
+                    bits, count = None, len(set(run_slots.tolist()))
+                if count >= self.bitmap_min:
+                    self.prefix_bits[prefix] = bits
+                else:
+                    self.prefix_counts[prefix] = count
+    
+    def mark(self, filename):
+        """ Adds a newly indexed recipe to the bitmaps, making bitmaps for words or prefixes that became common """
+        slot = self.slots[filename]
+        if slot >= 8*self.capacity:
+            grown = np.zeros(self.capacity, dtype=np.uint8)
+            for table in (self.word_bits, self.prefix_bits):
+                for key, bits in table.items():
+                    table[key] = np.concatenate([bits, grown])
+            self.capacity *= 2
+        byte, bit = slot >> 3, np.uint8(1 << (slot & 7))
+        words = self.recipe_words[filename].split()
+        for word in words:
+            bits = self.word_bits.get(word)
+            if bits is not None:
+                bits[byte] |= bit
+            elif len(self.postings[word]) >= self.bitmap_min:
+                self.word_bits[word] = self.bitmap(self.slot_array([self.postings[word]]))
+        for prefix in self.short_prefixes(words):
+            bits = self.prefix_bits.get(prefix)
+            if bits is not None:
+                bits[byte] |= bit
+                continue
+            self.prefix_counts[prefix] = self.prefix_counts.get(prefix, 0)+1
+            if self.prefix_counts[prefix] >= self.bitmap_min:
+                del self.prefix_counts[prefix]
+                self.prefix_bits[prefix] = self.bitmap(self.slot_array(self.postings[word]
+                                                                       for word in self.prefix_words(prefix)))
+    
+    def prefix_words(self, prefix):
+        """ Returns the indexed words that start with prefix """
+        lo = bisect.bisect_left(self.words, prefix)
+        hi = bisect.bisect_left(self.words, prefix+"\uffff", lo)
+        return self.words[lo:hi]
+    
+    def prefix_mask(self, prefix, words):
+        """
+        Returns a boolean array over the slots marking recipes with a word starting with prefix,
+        or None if that would mean reading the postings of many words
+        """
+        n = len(self.slot_files)
+        bits = self.prefix_bits.get(prefix)
+        if bits is not None:
+            return np.unpackbits(bits, count=n, bitorder='little').view(bool)
+        if len(words) > 16 and len(prefix) > 2:
+            return None
+        # A short prefix without a bitmap is rare, so its postings are few
+        mask = np.zeros(n, dtype=bool)
+        rare = []
+        for word in words:
+            bits = self.word_bits.get(word)
+            if bits is None:
+                rare.append(self.postings[word])
+            else:
+                mask |= np.unpackbits(bits, count=n, bitorder='little').view(bool)
+        mask[self.slot_array(rare)] = True
+        return mask
+    
+    def slot_filenames(self, mask):
+        """ Yields the filenames of the slots set in mask, in slot order, a chunk at a time so callers can stop early """
+        slots = np.flatnonzero(mask)
+        for lo in range(0, len(slots), 256):
+            yield from map(self.slot_files.__getitem__, slots[lo:lo+256].tolist())
+    
+    def first_seen(self, postings):
+        """ Yields the filenames in several postings, each once """
+        seen = set()
+        for posting in postings:
+            for filename in posting:
+                if filename not in seen:
+                    seen.add(filename)
+                    yield filename
+    
+    def matches(self, query):
+        """
+        Yields recipes having, for every word of the query, a word starting with it, in index order
+        When even the rarest prefix matches many recipes, the prefixes' bitmaps are ANDed;
+        otherwise the rarest prefix's postings are walked through a chain of lazy filters, so callers can stop early
+        """
+        terms = []
+        for prefix in set(search_tokens(query)):
+            words = self.prefix_words(prefix)
+            if not words:
+                return
+            if len(words) <= 16:
+                size = sum(len(self.postings[word]) for word in words)
+            elif prefix in self.prefix_counts:
+                size = self.prefix_counts[prefix]
+            elif prefix in self.prefix_bits:
+                size = len(self.recipes)
+            else:
+                # Summing the postings of many words costs more than the search, so count the words instead
+                size = len(words)
+            terms.append((size, prefix, words))
+        if not terms:
+            return
+        terms.sort()
+        mask, checks = None, []
+        if len(terms) > 1 and terms[0][0] >= self.bitmap_min:
+            for _, prefix, words in terms:
+                found = self.prefix_mask(prefix, words)
+                if found is None:
+                    checks.append(prefix)
+                elif mask is None:
+                    mask = found
+                else:
+                    mask &= found
+        if mask is not None:
+            found = self.slot_filenames(mask)
+        else:
+            words = terms[0][2]
+            found = iter(self.postings[words[0]]) if len(words)==1 else \
+                    self.first_seen(self.postings[word] for word in words)
+            checks = []
+            # Rarest prefixes first, so later filters see fewer recipes. A prefix of one word probes its posting;
+            # the rest are looked for in each recipe's words. Both run in C, with no Python call per recipe
+            for _, prefix, words in terms[1:]:
+                if len(words)==1:
+                    found = filter(self.postings[words[0]].__contains__, found)
+                else:
+                    checks.append(prefix)
+        for prefix in checks:
+            found, probe = itertools.tee(found)
+            words = map(self.recipe_words.__getitem__, probe)
+            found = itertools.compress(found, map(operator.contains, words, itertools.repeat(" "+prefix)))
+        yield from map(self.recipes.__getitem__, found)
+    
+    def search(self, query, limit=None):
+        """ Returns up to limit recipes matching the query (see matches) """
+        return list(itertools.islice(self.matches(query), limit))
+
+def recipe_property(attr):
+    """ Makes a Meal property that reads and writes its shared Recipe """
+    return property(lambda self: getattr(self.base_recipe, attr),
+                    lambda self, value: setattr(self.base_recipe, attr, value))
+
+def find_recipe(filename, recipe_dir=saved_recipes, registry=None):
+    """ Returns the shared Recipe for a saved recipe file """
+    if registry is None:
+        registry = recipe_registry
+    if recipe_dir+filename not in registry and not os.path.exists(recipe_dir+filename):
+        raise ValueError(f"Recipe file not found: {filename}")
+    return registry.get(filename, recipe_dir)
 
 ### Meal Class
-class Meal(Recipe):
+class Meal:
+    
+    __slots__ = ('base_recipe', 'date', 'category')
+    
+    # Recipe details live on the shared Recipe object
+    filename = recipe_property('filename')
+    name = recipe_property('name')
+    servings = recipe_property('servings')
+    ingredients = recipe_property('ingredients')
+    instructions = recipe_property('instructions')
+    percent = recipe_property('percent')
+    accept = recipe_property('accept')
     
-    def __init__(self, filename, name="", m_date=date.today(), category="snack", servings=0, ingredients={},
-                 instructions="", recipe_dir=saved_recipes):
+    def __init__(self, filename, m_date=date.today(), category="snack", recipe_dir=saved_recipes,
+                 registry=None):
         """ Initializes the Meal class """
-        if not os.path.exists(recipe_dir+filename):
-            raise ValueError(f"Recipe file not found: {filename}")
-        super().__init__(filename, name, servings, ingredients, instructions)
+        self.base_recipe = find_recipe(filename, recipe_dir, registry)
         if type(m_date) is not date:
             raise ValueError(f"Invalid date: {m_date}")
         self.date = m_date
@@ -225,7 +831,12 @@ class Meal(Recipe):
         self.category = category.lower()
     
     def __eq__(self, other):
-        return self.date==other.date and self.filename==other.filename and self.category==other.category
+        if type(other) is not Meal:
+            return NotImplemented
+        return meal_key(self)==meal_key(other)
+    
+    def __hash__(self):
+        return hash(meal_key(self))
     
     def __lt__(self, other):
         return self.date < other.date
@@ -236,156 +847,1286 @@ class Meal(Recipe):
     def __str__(self):
         return f"Meal: {self.name}, date: {self.date}, category: {self.category}"
     
+    def __repr__(self):
+        return str(self)
+    
     def recipe(self):
         """ Returns the Recipe object corresponding to the meal """
-        file = os.path.basename(self.filename)
-        #return Recipe(file, self.name, self.servings, self.ingredients, self.instructions)
-        return super().from_file(file)
+        return self.base_recipe
+    
+    @classmethod
+    def view(cls, recipe, m_date, category):
+        """ Makes a Meal from an already loaded Recipe, skipping the checks in __init__ """
+        meal = cls.__new__(cls)
+        meal.base_recipe = recipe
+        meal.date = m_date
+        meal.category = category
+        return meal
     
     def copy(self):
-        file = os.path.basename(self.filename)
-        return Meal(file, m_date=self.date, category=self.category)
+        """ Returns a new Meal sharing the same Recipe """
+        return Meal.view(self.base_recipe, self.date, self.category)
+    
+    def grams(self):
+        """ Returns a food:grams dictionary for the meal's recipe """
+        return self.base_recipe.grams()
+    
+    def to_file(self):
+        """ Saves the meal's recipe to file """
+        self.base_recipe.to_file()
 
 # Could theoretically have a separate meal file named for the recipe if there are edits?
 
+### Meal Store
+class MealStore:
+    
+    def __init__(self, meals=[]):
+        """
+        Keeps meals as columns: date ordinal (int32), recipe id (int32) and category code (uint8)
+        Each meal is also packed into one integer code that sorts by date, then category, then recipe,
+        kept in a sorted list per day (with the days sorted, for date ranges) and in a set per recipe (for cascades,
+        built on first use)
+        Meal objects are only made, as views, when meals are read back
+        """
+        self.size = 0
+        self.ordinals = np.zeros(0, dtype=np.int32)
+        self.recipe_ids = np.zeros(0, dtype=np.int32)
+        self.categories = np.zeros(0, dtype=np.uint8)
+        self.recipes = [] # recipe id -> Recipe
+        self.ids = {} # recipe basename -> recipe id
+        self.rows = {} # meal code -> row
+        self.days = [] # date ordinals that have meals, sorted
+        self.day_codes = {} # date ordinal -> sorted meal codes
+        self.recipe_codes = None # recipe id -> set of meal codes, built by recipe_index()
+        for meal in meals:
+            self.add(meal)
+    
+    @classmethod
+    def from_rows(cls, rows, recipe_dir=saved_recipes, registry=None):
+        """ Builds a store from saved (filename, date, category) rows, a column at a time """
+        store = cls()
+        if not rows:
+            return store
+        filenames, dates, categories = zip(*rows)
+        file_ids = {}
+        for filename in dict.fromkeys(filenames):
+            recipe = find_recipe(filename, recipe_dir, registry)
+            if recipe.basename not in store.ids:
+                store.ids[recipe.basename] = len(store.recipes)
+                store.recipes.append(recipe)
+            file_ids[filename] = store.ids[recipe.basename]
+        codes = {category: i for i, category in enumerate(meal_categories)}
+        try:
+            category_codes = [codes[category.lower()] for category in categories]
+        except KeyError as e:
+            raise ValueError(f"Invalid category: {e.args[0]}")
+        ordinals = np.fromiter((d.toordinal() for d in dates), dtype=np.int64, count=len(rows))
+        recipe_ids = np.fromiter((file_ids[filename] for filename in filenames), dtype=np.int64, count=len(rows))
+        category_codes = np.array(category_codes, dtype=np.int64)
+        # Keep the first of any repeated meal
+        row_codes = (ordinals << 32) | (category_codes << 24) | recipe_ids
+        _, first = np.unique(row_codes, return_index=True)
+        first.sort()
+        store.size = len(first)
+        store.ordinals = ordinals[first].astype(np.int32)
+        store.recipe_ids = recipe_ids[first].astype(np.int32)
+        store.categories = category_codes[first].astype(np.uint8)
+        # Group the codes by day with one sort, sharing one int object per code
+        order = np.argsort(row_codes[first], kind='stable')
+        sorted_codes = row_codes[first][order]
+        meal_codes = sorted_codes.tolist()
+        store.rows = dict(zip(meal_codes, order.tolist()))
+        days, starts = np.unique(sorted_codes >> 32, return_index=True)
+        store.days = days.tolist()
+        bounds = starts.tolist()+[store.size]
+        store.day_codes = {day: meal_codes[lo:hi] for day, lo, hi in zip(store.days, bounds, bounds[1:])}
+        return store
+    
+    def __len__(self):
+        return self.size
+    
+    def __iter__(self):
+        return iter(self.views(self.sorted_codes()))
+    
+    def __contains__(self, meal):
+        return type(meal) is Meal and self.code(meal) in self.rows
+    
+    def code(self, meal, add=False):
+        """ Returns the integer identity of a meal's (filename, date, category) key """
+        recipe = meal.base_recipe
+        rid = self.ids.get(recipe.basename)
+        if rid is None:
+            if not add:
+                return None
+            rid = self.ids[recipe.basename] = len(self.recipes)
+            self.recipes.append(recipe)
+        elif add:
+            self.recipes[rid] = recipe # the registry may hold a newer object
+        return self.row_code(meal.date.toordinal(), rid, meal_categories.index(meal.category))
+    
+    def row_code(self, ordinal, rid, category):
+        """ Packs a row's columns into one integer, ordered by date, then category, then recipe """
+        return (int(ordinal) << 32) | (int(category) << 24) | int(rid)
+    
+    def views(self, codes):
+        """ Returns Meal views of the given meal codes """
+        return [Meal.view(self.recipes[code & 0xffffff], date.fromordinal(code >> 32),
+                          meal_categories[(code >> 24) & 0xff]) for code in codes]
+    
+    def recipe_index(self):
+        """ Returns the recipe id -> meal codes sets, building them from the columns if needed """
+        if self.recipe_codes is None:
+            codes = list(self.rows)
+            rids = np.fromiter(self.rows, dtype=np.int64, count=len(codes)) & 0xffffff
+            by_recipe = np.argsort(rids, kind='stable')
+            ids, starts = np.unique(rids[by_recipe], return_index=True)
+            grouped = [codes[i] for i in by_recipe.tolist()]
+            bounds = starts.tolist()+[len(codes)]
+            self.recipe_codes = {rid: set(grouped[lo:hi]) for rid, lo, hi in zip(ids.tolist(), bounds, bounds[1:])}
+        return self.recipe_codes
+    
+    def sorted_codes(self, lo=0, hi=None):
+        """ Returns the meal codes of days[lo:hi], in order """
+        return [code for day in self.days[lo:hi] for code in self.day_codes[day]]
+    
+    def keys(self):
+        """ Returns the keys of all meals, in date order """
+        return [(self.recipes[code & 0xffffff].basename, date.fromordinal(code >> 32),
+                 meal_categories[(code >> 24) & 0xff]) for code in self.sorted_codes()]
+    
+    def copy(self):
+        """ Returns a copy of the store """
+        store = MealStore()
+        store.size = self.size
+        store.ordinals = self.ordinals[:self.size].copy()
+        store.recipe_ids = self.recipe_ids[:self.size].copy()
+        store.categories = self.categories[:self.size].copy()
+        store.recipes = list(self.recipes)
+        store.ids = dict(self.ids)
+        store.rows = dict(self.rows)
+        store.days = list(self.days)
+        store.day_codes = {day: list(codes) for day, codes in self.day_codes.items()}
+        if self.recipe_codes is not None:
+            store.recipe_codes = {rid: set(codes) for rid, codes in self.recipe_codes.items()}
+        return store
+    
+    def add(self, meal):
+        """ Adds a meal, returning False if an equal meal is already stored """
+        code = self.code(meal, add=True)
+        if code in self.rows:
+            return False
+        if self.size==len(self.ordinals):
+            # Grow the columns geometrically so appends stay amortized O(1)
+            capacity = max(16, 2*self.size)
+            for name in ('ordinals', 'recipe_ids', 'categories'):
+                column = getattr(self, name)
+                grown = np.zeros(capacity, dtype=column.dtype)
+                grown[:self.size] = column[:self.size]
+                setattr(self, name, grown)
+        row = self.size
+        rid = self.ids[meal.base_recipe.basename]
+        self.ordinals[row] = meal.date.toordinal()
+        self.recipe_ids[row] = rid
+        self.categories[row] = meal_categories.index(meal.category)
+        self.rows[code] = row
+        day = code >> 32
+        codes = self.day_codes.get(day)
+        if codes is None:
+            bisect.insort(self.days, day)
+            self.day_codes[day] = [code]
+        else:
+            bisect.insort(codes, code)
+        if self.recipe_codes is not None:
+            self.recipe_codes.setdefault(rid, set()).add(code)
+        self.size += 1
+        return True
+    
+    def remove(self, meal):
+        """ Removes a meal, returning False if it wasn't there """
+        code = self.code(meal)
+        row = self.rows.pop(code, None)
+        if row is None:
+            return False
+        self.remove_row(row)
+        if self.recipe_codes is not None:
+            self.recipe_codes[code & 0xffffff].discard(code)
+        day = code >> 32
+        codes = self.day_codes[day]
+        codes.remove(code)
+        if not codes:
+            del self.day_codes[day]
+            del self.days[bisect.bisect_left(self.days, day)]
+        return True
+    
+    def remove_row(self, row):
+        """ Removes a row by moving the last row into its place """
+        last = self.size-1
+        if row!=last:
+            for column in (self.ordinals, self.recipe_ids, self.categories):
+                column[row] = column[last]
+            self.rows[self.row_code(self.ordinals[row], self.recipe_ids[row], self.categories[row])] = row
+        self.size = last
+    
+    def remove_recipe(self, recipe):
+        """ Removes every meal made from a recipe, returning their keys in date order """
+        rid = self.ids.get(recipe.basename)
+        codes = sorted(self.recipe_index().pop(rid, ()))
+        emptied = False
+        for code in codes:
+            self.remove_row(self.rows.pop(code))
+            day = code >> 32
+            day_codes = self.day_codes[day]
+            day_codes.remove(code)
+            if not day_codes:
+                del self.day_codes[day]
+                emptied = True
+        if emptied:
+            # One pass over the days, rather than shifting the list once per emptied day
+            self.days = [day for day in self.days if day in self.day_codes]
+        return [(recipe.basename, date.fromordinal(code >> 32), meal_categories[(code >> 24) & 0xff])
+                for code in codes]
+    
+    def recipe_meals(self, recipe):
+        """ Returns views of every meal made from a recipe, in date order """
+        rid = self.ids.get(recipe.basename)
+        return self.views(sorted(self.recipe_index().get(rid, ())))
+    
+    def uses(self, rid):
+        """ Returns whether any meal is made from the recipe id """
+        return bool(self.recipe_index().get(rid))
+    
+    def between(self, start, end, category=None):
+        """ Returns views of meals with start <= date < end (and the given category), in date order """
+        lo = bisect.bisect_left(self.days, start.toordinal())
+        hi = bisect.bisect_left(self.days, end.toordinal(), lo)
+        codes = self.sorted_codes(lo, hi)
+        if category is not None:
+            code = meal_categories.index(category)
+            codes = [c for c in codes if (c >> 24) & 0xff==code]
+        return self.views(codes)
+
+### Ingredient Matrix
+class IngredientMatrix:
+    
+    def __init__(self, recipes=[]):
+        """ Sparse recipe x ingredient matrix of grams, stored as coordinate arrays """
+        self.foods = {} # food name -> column
+        self.names = [] # column -> food name
+        self.food_recipes = {} # normalized food name -> filenames of the recipes using it
+        self.recipe_foods = {} # recipe filename -> normalized food names it uses
+        self.rows = {} # recipe filename -> row
+        self.recipes = [] # row -> recipe
+        self.entries = [] # row -> (columns, grams) arrays
+        self.coords = None # concatenated (rows, columns, grams), rebuilt when stale
+        for recipe in recipes:
+            self.set_recipe(recipe)
+    
+    def __len__(self):
+        return len(self.recipes)
+    
+    def set_recipe(self, recipe):
+        """ Adds a recipe's row, or replaces it if the recipe is already there """
+        grams = recipe.grams()
+        for food in grams:
+            if food not in self.foods:
+                self.foods[food] = len(self.names)
+                self.names.append(food)
+        cols = [self.foods[food] for food in grams]
+        self.index_foods(recipe.filename, {normalize_food(food) for food in grams})
+        entry = (np.array(cols, dtype=np.int64), np.array(list(grams.values()), dtype=float))
+        row = self.rows.get(recipe.filename)
+        if row is None:
+            self.rows[recipe.filename] = len(self.recipes)
+            self.recipes.append(recipe)
+            self.entries.append(entry)
+        else:
+            self.recipes[row] = recipe
+            self.entries[row] = entry
+        self.coords = None
+    
+    def remove_recipe(self, recipe):
+        """ Removes a recipe's row (the last row moves into its place) """
+        row = self.rows.pop(recipe.filename, None)
+        if row is None:
+            return
+        self.index_foods(recipe.filename, set())
+        last = len(self.recipes)-1
+        if row!=last:
+            self.recipes[row] = self.recipes[last]
+            self.entries[row] = self.entries[last]
+            self.rows[self.recipes[row].filename] = row
+        self.recipes.pop()
+        self.entries.pop()
+        self.coords = None
+    
+    def index_foods(self, filename, names):
+        """ Points the food -> recipes index at a recipe's current foods """
+        for name in self.recipe_foods.pop(filename, set()) - names:
+            users = self.food_recipes[name]
+            users.discard(filename)
+            if not users:
+                del self.food_recipes[name]
+        for name in names:
+            self.food_recipes.setdefault(name, set()).add(filename)
+        if names:
+            self.recipe_foods[filename] = names
+    
+    def food_rows(self, foods):
+        """ Returns the sorted rows of the recipes that use any of the foods """
+        rows = {self.rows[filename] for food in foods
+                for filename in self.food_recipes.get(normalize_food(food), ())}
+        return np.array(sorted(rows), dtype=np.int64)
+    
+    def coordinates(self):
+        """ Returns the (rows, columns, grams) arrays of all nonzero entries """
+        if self.coords is None:
+            lengths = [len(cols) for cols, grams in self.entries]
+            rows = np.repeat(np.arange(len(self.entries)), lengths)
+            if self.entries:
+                cols = np.concatenate([cols for cols, grams in self.entries])
+                grams = np.concatenate([grams for cols, grams in self.entries])
+            else:
+                cols = np.zeros(0, dtype=np.int64)
+                grams = np.zeros(0)
+            self.coords = (rows, cols, grams)
+        return self.coords
+    
+    def diet_vectors(self, diet_index, columns=None):
+        """ Returns restricted (including banned) and banned indicator vectors over the food columns (or just the given ones) """
+        names = self.names if columns is None else [self.names[col] for col in columns]
+        classes = [diet_index.classify(food) for food in names]
+        banned = np.array([c=='banned' for c in classes], dtype=float)
+        restricted = np.array([c!='allowed' for c in classes], dtype=float)
+        return restricted, banned
+    
+    def class_totals(self, diet_index, rows=None):
+        """
+        Returns restricted grams (including banned), other grams and the number of banned foods per row
+        Given a sorted array of rows, only those are totalled (in that order)
+        """
+        if rows is None:
+            rows, cols, grams = self.coordinates()
+            restricted_vec, banned_vec = self.diet_vectors(diet_index)
+            n = len(self.recipes)
+        else:
+            n = len(rows)
+            entries = [self.entries[row] for row in rows.tolist()]
+            lengths = [len(cols) for cols, grams in entries]
+            cols = np.concatenate([cols for cols, grams in entries] or [np.zeros(0, dtype=np.int64)])
+            grams = np.concatenate([grams for cols, grams in entries] or [np.zeros(0)])
+            rows = np.repeat(np.arange(n), lengths)
+            # Only classify the foods these rows use
+            columns, cols = np.unique(cols, return_inverse=True)
+            restricted_vec, banned_vec = self.diet_vectors(diet_index, columns.tolist())
+        # Sparse mat-vecs: per-row sums of grams weighted by the indicator vectors
+        restricted = np.bincount(rows, weights=grams*restricted_vec[cols], minlength=n)
+        other = np.bincount(rows, weights=grams*(1-restricted_vec[cols]), minlength=n)
+        banned = np.bincount(rows, weights=banned_vec[cols], minlength=n)
+        return restricted, other, banned
+    
+    def score(self, diet_index):
+        """ Returns accept and percent arrays for every row, as check_foods would """
+        return compliance(*self.class_totals(diet_index))
+
+def compliance(restricted, other, banned):
+    """
+    Vectorized version of the check_foods rule, from restricted grams (including banned),
+    other grams and the number of banned foods. Returns accept and percent arrays
+    """
+    restricted = np.asarray(restricted, dtype=float)
+    total = restricted+other
+    has_restricted = restricted!=0
+    percent = np.divide(restricted, total, out=np.zeros(restricted.shape), where=has_restricted)
+    accept = np.where(has_restricted, percent<=restricted_limit, np.asarray(banned)==0)
+    return accept, percent
+
+### Daily Totals
+class DailyTotals:
+    
+    def __init__(self, ordinals, restricted, other, banned):
+        """
+        Cumulative per-day diet totals for a list of meals, given each meal's
+        date ordinal and its restricted grams, other grams and banned food count
+        """
+        ordinals = np.asarray(ordinals, dtype=np.int64)
+        self.first = int(ordinals.min()) if len(ordinals) else 0
+        n = int(ordinals.max())-self.first+1 if len(ordinals) else 0
+        days = ordinals-self.first
+        # prefix[k][i] is the total over the first i days
+        self.prefix = [np.concatenate([[0.], np.cumsum(np.bincount(days, weights=w, minlength=n))])
+                       for w in (restricted, other, banned)]
+    
+    def window(self, start, days):
+        """ Returns (restricted, other, banned) summed over start <= date < start + days """
+        lo = np.clip(np.asarray(start)-self.first, 0, len(self.prefix[0])-1)
+        hi = np.clip(np.asarray(start)+days-self.first, 0, len(self.prefix[0])-1)
+        return tuple(p[hi]-p[lo] for p in self.prefix)
+
+### Storage
+class FileStorage:
+    
+    def __init__(self, diet_file=saved_diet, meal_file=saved_meals, recipe_dir=saved_recipes, workers=1,
+                 pool='process', snapshot_file=None):
+        """
+        Stores a plan as a diet csv, a meal csv and one text file per recipe
+        workers > 1 parses the recipe directory in parallel on a 'process' or 'thread' pool
+        snapshot_file keeps everything parsed in one binary file, so unchanged files aren't re-read;
+        a bare file name goes next to the meal file, prefixed with its name, so plans sharing a folder don't collide
+        """
+        self.diet_file = diet_file
+        self.meal_file = meal_file
+        self.recipe_dir = recipe_dir
+        self.workers = workers
+        self.pool = pool
+        if snapshot_file is not None and not os.path.dirname(snapshot_file):
+            folder, name = os.path.split(meal_file)
+            snapshot_file = os.path.join(folder, f".{name}{snapshot_file}")
+        self.snapshot_file = snapshot_file
+        self.snapshot = self.read_snapshot()
+        self.snapshot_changed = False
+    
+    def read_snapshot(self):
+        """ Returns the saved snapshot, or an empty one if it is missing, unreadable or out of date """
+        files = tuple(os.path.abspath(path) for path in (self.diet_file, self.meal_file, self.recipe_dir))
+        empty = {'version': snapshot_version, 'files': files,
+                 'recipes': {}, 'meals': None, 'diet': None}
+        if self.snapshot_file is None or not os.path.exists(self.snapshot_file):
+            return empty
+        try:
+            with open(self.snapshot_file, 'rb') as f:
+                snapshot = pickle.load(f)
+        except Exception: # a damaged snapshot is just a cold start
+            return empty
+        if type(snapshot) is not dict or snapshot.get('version')!=snapshot_version or \
+           snapshot.get('files')!=empty['files']:
+            return empty
+        return snapshot
+    
+    def checkpoint(self):
+        """ Saves the snapshot if anything in it changed """
+        if self.snapshot_file is not None and self.snapshot_changed:
+            atomic_write(self.snapshot_file, pickle.dumps(self.snapshot, protocol=pickle.HIGHEST_PROTOCOL))
+            self.snapshot_changed = False
+    
+    def load_recipes(self):
+        """ Returns (filename, fields) for every recipe file, sorted by filename """
+        if not os.path.exists(self.recipe_dir):
+            os.mkdir(self.recipe_dir)
+        paths = sorted(glob.glob(self.recipe_dir+"*"))
+        # Only files whose mtime or size changed since the snapshot are parsed again
+        cached = self.snapshot['recipes']
+        entries = {}
+        stale = []
+        for path in paths:
+            filename = os.path.basename(path)
+            stamp = file_stamp(path)
+            entry = cached.get(filename)
+            if entry is not None and entry[0]==stamp:
+                entries[filename] = entry
+            else:
+                stale.append((filename, path, stamp))
+        if self.workers > 1 and len(stale) > 1:
+            parsed = self.parse_parallel([path for _, path, _ in stale])
+        else:
+            parsed = [read_recipe_file(path) for _, path, _ in stale]
+        for (filename, _, stamp), fields in zip(stale, parsed):
+            entries[filename] = (stamp, fields)
+        if stale or len(entries)!=len(cached):
+            self.snapshot['recipes'] = entries
+            self.snapshot_changed = True
+        # Merge in sorted filename order so the result doesn't depend on the pool
+        return [(os.path.basename(path), entries[os.path.basename(path)][1]) for path in paths]
+    
+    def parse_parallel(self, paths):
+        """ Parses recipe files concurrently, returning their fields in the same order as paths """
+        if self.pool=='process':
+            executor = concurrent.futures.ProcessPoolExecutor # loads multiprocessing on first use
+        elif self.pool=='thread':
+            executor = concurrent.futures.ThreadPoolExecutor
+        else:
+            raise ValueError(f"Invalid pool: {self.pool}")
+        chunksize = max(1, len(paths)//(self.workers*4))
+        with executor(max_workers=self.workers) as ex:
+            return list(ex.map(read_recipe_file, paths, chunksize=chunksize))
+    
+    def load_recipe(self, filename):
+        """ Returns the saved fields of one recipe, or None if it isn't saved """
+        if not os.path.exists(self.recipe_dir+filename):
+            return None
+        return read_recipe_file(self.recipe_dir+filename)
+    
+    def save_recipe(self, filename, fields):
+        """ Writes one recipe file """
+        atomic_write(self.recipe_dir+filename, format_recipe(fields))
+        self.snapshot['recipes'][filename] = (file_stamp(self.recipe_dir+filename), fields)
+        self.snapshot_changed = True
+    
+    def delete_recipe(self, filename):
+        """ Deletes one recipe file """
+        if os.path.exists(self.recipe_dir+filename):
+            os.remove(self.recipe_dir+filename)
+        if self.snapshot['recipes'].pop(filename, None) is not None:
+            self.snapshot_changed = True
+    
+    def load_meals(self):
+        """ Returns (filename, date, category) for every saved meal """
+        if not os.path.exists(self.meal_file):
+            self.save_meals([])
+            return []
+        stamp = file_stamp(self.meal_file)
+        if self.snapshot['meals'] is not None and self.snapshot['meals'][0]==stamp:
+            return self.snapshot['meals'][1]
+        with open(self.meal_file, newline='') as f:
+            reader = csv.reader(f)
+            next(reader, None) # header
+            # Repeated names and dates share one object, which keeps the snapshot small
+            shared = {}
+            dates = {}
+            rows = []
+            for row in reader:
+                if len(row) < 3:
+                    continue # blank or cut-off line
+                filename, m_date, category = row[:3]
+                if m_date not in dates:
+                    dates[m_date] = date.fromisoformat(m_date)
+                rows.append((shared.setdefault(filename, filename), dates[m_date],
+                             shared.setdefault(category, category)))
+        self.snapshot['meals'] = (stamp, rows)
+        self.snapshot_changed = True
+        return rows
+    
+    def add_meals(self, keys):
+        """ Appends meals to the end of the meal file """
+        if not os.path.exists(self.meal_file):
+            self.save_meals(keys)
+            return
+        keys = list(keys)
+        cached = self.snapshot['meals']
+        fresh = cached is not None and cached[0]==file_stamp(self.meal_file)
+        with open(self.meal_file, 'a', newline='') as f:
+            csv.writer(f, lineterminator="\n").writerows(meal_row(key) for key in keys)
+        # Keep the cached rows in step with the file, unless they were already out of date
+        self.snapshot['meals'] = (file_stamp(self.meal_file), cached[1]+keys) if fresh else None
+        self.snapshot_changed = True
+    
+    def add_meal(self, key):
+        """ Appends a single meal to the end of the meal file """
+        self.add_meals([key])
+    
+    def remove_meals(self, keys, remaining):
+        """ Removes meals (the flat csv can only be rewritten from the remaining meals) """
+        self.save_meals(remaining)
+    
+    def save_meals(self, keys):
+        """ Rewrites the meal file """
+        s = io.StringIO()
+        writer = csv.writer(s, lineterminator="\n")
+        writer.writerow(meal_columns)
+        keys = list(keys)
+        writer.writerows(meal_row(key) for key in keys)
+        atomic_write(self.meal_file, s.getvalue())
+        self.snapshot['meals'] = (file_stamp(self.meal_file), keys)
+        self.snapshot_changed = True
+    
+    def load_diet(self):
+        """ Returns the diet as a dictionary of food lists """
+        stamp = file_stamp(self.diet_file)
+        if stamp is not None and self.snapshot['diet'] is not None and self.snapshot['diet'][0]==stamp:
+            return {col: list(foods) for col, foods in self.snapshot['diet'][1].items()}
+        if not os.path.exists(self.diet_file):
+            diet = {col: [] for col in diet_columns}
+            self.save_diet(diet)
+            return diet
+        with open(self.diet_file, newline='') as f:
+            reader = csv.reader(f)
+            columns = next(reader, [])
+            diet = {col: [] for col in columns}
+            for row in reader:
+                for col, val in zip(columns, row):
+                    if val!="":
+                        diet[col].append(val)
+        self.snapshot['diet'] = (file_stamp(self.diet_file), {col: list(foods) for col, foods in diet.items()})
+        self.snapshot_changed = True
+        return diet
+    
+    def save_diet(self, diet):
+        """ Saves the diet plan to the diet file """
+        columns = [diet.get(col, []) for col in diet_columns]
+        s = io.StringIO()
+        writer = csv.writer(s, lineterminator="\n")
+        writer.writerow(diet_columns)
+        writer.writerows(itertools.zip_longest(*columns, fillvalue=''))
+        atomic_write(self.diet_file, s.getvalue())
+        self.snapshot['diet'] = (file_stamp(self.diet_file), {col: list(diet.get(col, [])) for col in diet_columns})
+        self.snapshot_changed = True
+    
+    def transaction(self):
+        """ Files are written one at a time, so there is nothing to group """
+        return contextlib.nullcontext()
+    
+    def close(self):
+        self.checkpoint()
+
+sqlite_schema = """
+    CREATE TABLE IF NOT EXISTS recipes (
+        id INTEGER PRIMARY KEY,
+        filename TEXT UNIQUE NOT NULL,
+        name TEXT,
+        servings REAL,
+        instructions TEXT
+    );
+    CREATE TABLE IF NOT EXISTS ingredients (
+        recipe_id INTEGER NOT NULL REFERENCES recipes(id) ON DELETE CASCADE,
+        position INTEGER NOT NULL,
+        quantity REAL,
+        units TEXT,
+        food TEXT
+    );
+    CREATE INDEX IF NOT EXISTS ingredients_recipe ON ingredients(recipe_id);
+    CREATE TABLE IF NOT EXISTS meals (
+        filename TEXT NOT NULL,
+        date TEXT NOT NULL,
+        category TEXT NOT NULL,
+        PRIMARY KEY (filename, date, category)
+    );
+    CREATE INDEX IF NOT EXISTS meals_date ON meals(date);
+    CREATE TABLE IF NOT EXISTS diet (
+        category TEXT NOT NULL,
+        position INTEGER NOT NULL,
+        food TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS diet_food ON diet(food);
+"""
+
+class SQLiteStorage:
+    
+    def __init__(self, db_file='diet.db'):
+        """ Stores a plan in a single SQLite database """
+        self.db_file = db_file
+        self.db = sqlite3.connect(db_file, check_same_thread=False)
+        self.db.execute("PRAGMA foreign_keys = ON")
+        self.db.executescript(sqlite_schema)
+        self.depth = 0 # open transaction() blocks
+    
+    @contextlib.contextmanager
+    def transaction(self):
+        """ Groups writes into one commit (rolled back if the block raises) """
+        self.depth += 1
+        try:
+            yield self
+        except BaseException:
+            self.depth -= 1
+            if self.depth==0:
+                self.db.rollback()
+            raise
+        self.depth -= 1
+        self.commit()
+    
+    def commit(self):
+        """ Commits unless a transaction() block is still open """
+        if self.depth==0:
+            self.db.commit()
+    
+    def load_recipes(self):
+        """ Returns (filename, fields) for every recipe, sorted by filename """
+        ingredients = {}
+        for recipe_id, quantity, unit, food in self.db.execute(
+                "SELECT recipe_id, quantity, units, food FROM ingredients ORDER BY recipe_id, position"):
+            ingredients.setdefault(recipe_id, []).append([quantity, unit, food])
+        rows = self.db.execute("SELECT id, filename, name, servings, instructions FROM recipes ORDER BY filename")
+        return [(filename, {'name': name, 'servings': servings, 'ingredients': ingredients.get(recipe_id, []),
+                            'instructions': instructions})
+                for recipe_id, filename, name, servings, instructions in rows]
+    
+    def load_recipe(self, filename):
+        """ Returns the saved fields of one recipe, or None if it isn't saved """
+        row = self.db.execute("SELECT id, name, servings, instructions FROM recipes WHERE filename=?",
+                              (filename,)).fetchone()
+        if row is None:
+            return None
+        recipe_id, name, servings, instructions = row
+        ingredients = [list(r) for r in self.db.execute(
+            "SELECT quantity, units, food FROM ingredients WHERE recipe_id=? ORDER BY position", (recipe_id,))]
+        return {'name': name, 'servings': servings, 'ingredients': ingredients, 'instructions': instructions}
+    
+    def save_recipe(self, filename, fields):
+        """ Inserts or replaces one recipe and its ingredients """
+        self.db.execute(
+            "INSERT INTO recipes (filename, name, servings, instructions) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(filename) DO UPDATE SET name=excluded.name, servings=excluded.servings, "
+            "instructions=excluded.instructions",
+            (filename, fields.get('name', defaults['name']), fields.get('servings', defaults['servings']),
+             fields.get('instructions', defaults['instructions'])))
+        recipe_id = self.db.execute("SELECT id FROM recipes WHERE filename=?", (filename,)).fetchone()[0]
+        self.db.execute("DELETE FROM ingredients WHERE recipe_id=?", (recipe_id,))
+        self.db.executemany(
+            "INSERT INTO ingredients (recipe_id, position, quantity, units, food) VALUES (?, ?, ?, ?, ?)",
+            [(recipe_id, i, float(quantity), unit, food)
+             for i, (quantity, unit, food) in enumerate(fields.get('ingredients', []))])
+        self.commit()
+    
+    def delete_recipe(self, filename):
+        """ Deletes one recipe (its ingredients go with it) """
+        self.db.execute("DELETE FROM recipes WHERE filename=?", (filename,))
+        self.commit()
+    
+    def load_meals(self):
+        """ Returns (filename, date, category) for every saved meal """
+        rows = self.db.execute("SELECT filename, date, category FROM meals ORDER BY rowid")
+        return [(filename, date.fromisoformat(m_date), category) for filename, m_date, category in rows]
+    
+    def meals_between(self, start, end):
+        """ Returns (filename, date, category) for meals with start <= date < end, through the date index """
+        rows = self.db.execute("SELECT filename, date, category FROM meals WHERE date >= ? AND date < ? "
+                               "ORDER BY date", (start.isoformat(), end.isoformat()))
+        return [(filename, date.fromisoformat(m_date), category) for filename, m_date, category in rows]
+    
+    def add_meals(self, keys):
+        """ Inserts meals """
+        self.db.executemany("INSERT OR IGNORE INTO meals (filename, date, category) VALUES (?, ?, ?)",
+                            [meal_row(key) for key in keys])
+        self.commit()
+    
+    def add_meal(self, key):
+        """ Inserts a single meal """
+        self.add_meals([key])
+    
+    def remove_meals(self, keys, remaining):
+        """ Deletes meals by key (remaining is never read) """
+        self.db.executemany("DELETE FROM meals WHERE filename=? AND date=? AND category=?",
+                            [meal_row(key) for key in keys])
+        self.commit()
+    
+    def save_meals(self, keys):
+        """ Replaces every saved meal """
+        self.db.execute("DELETE FROM meals")
+        self.db.executemany("INSERT OR IGNORE INTO meals (filename, date, category) VALUES (?, ?, ?)",
+                            [meal_row(key) for key in keys])
+        self.commit()
+    
+    def load_diet(self):
+        """ Returns the diet as a dictionary of food lists """
+        diet = {category: [] for category in diet_columns}
+        for category, food in self.db.execute("SELECT category, food FROM diet ORDER BY category, position"):
+            diet.setdefault(category, []).append(food)
+        return diet
+    
+    def save_diet(self, diet):
+        """ Replaces the saved diet """
+        self.db.execute("DELETE FROM diet")
+        self.db.executemany("INSERT INTO diet (category, position, food) VALUES (?, ?, ?)",
+                            [(category, i, food) for category, foods in diet.items() for i, food in enumerate(foods)])
+        self.commit()
+    
+    def import_plan(self, source):
+        """ Copies every recipe, meal and diet food from another storage in one transaction """
+        with self.transaction():
+            for filename, fields in source.load_recipes():
+                self.save_recipe(filename, fields)
+            self.save_meals(source.load_meals())
+            self.save_diet(source.load_diet())
+    
+    def checkpoint(self):
+        """ The database is its own snapshot """
+        pass
+    
+    def close(self):
+        self.db.close()
+
+def migrate_to_sqlite(db_file, diet_file=saved_diet, meal_file=saved_meals, recipe_dir=saved_recipes):
+    """ One-shot copy of a csv/text file plan into a SQLite database; returns the new storage """
+    storage = SQLiteStorage(db_file)
+    storage.import_plan(FileStorage(diet_file, meal_file, recipe_dir))
+    return storage
+
+### Write-behind queue
+class WriteBehind:
+    
+    def __init__(self, plan, delay=0):
+        """
+        Collects a plan's pending writes and saves them together
+        delay > 0 waits that many seconds after an edit, so a burst of edits is saved in one flush
+        """
+        self.plan = plan
+        self.delay = delay
+        self.lock = plan.lock
+        self.timer = None
+        self.clear()
+    
+    def clear(self):
+        """ Drops all pending writes """
+        self.recipes = {} # filename -> Recipe to save
+        self.deleted = set() # recipe filenames to delete
+        self.added = {} # meal keys to append, in order
+        self.removed = set() # meal keys to delete
+        self.meals_changed = False # rewrite the whole meal list
+        self.diet_changed = False
+    
+    def pending(self):
+        """ Returns whether anything is waiting to be written """
+        return bool(self.recipes or self.deleted or self.added or self.removed or self.meals_changed
+                    or self.diet_changed)
+    
+    def save_recipe(self, recipe):
+        filename = os.path.basename(recipe.filename)
+        self.deleted.discard(filename)
+        self.recipes[filename] = recipe
+    
+    def delete_recipe(self, recipe):
+        filename = os.path.basename(recipe.filename)
+        self.recipes.pop(filename, None)
+        self.deleted.add(filename)
+    
+    def add_meal(self, key):
+        if key in self.removed: # removed and re-added before a flush
+            self.removed.discard(key)
+        else:
+            self.added[key] = None
+    
+    def remove_meal(self, key):
+        if key in self.added: # added and removed before a flush
+            del self.added[key]
+        else:
+            self.removed.add(key)
+    
+    def save_meals(self):
+        self.meals_changed = True
+    
+    def save_diet(self):
+        self.diet_changed = True
+    
+    def schedule(self):
+        """ Flushes now, or starts the delay timer if one isn't already running """
+        if self.plan.batch_depth > 0: # the batch flushes when it exits
+            return
+        if self.delay <= 0:
+            self.flush()
+            return
+        with self.lock:
+            if self.timer is None and self.pending():
+                self.timer = threading.Timer(self.delay, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+    
+    def flush(self):
+        """ Writes everything pending in one go """
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if not self.pending():
+                return
+            storage = self.plan.storage
+            with storage.transaction():
+                for filename in self.deleted:
+                    storage.delete_recipe(filename)
+                for filename, recipe in self.recipes.items():
+                    storage.save_recipe(filename, recipe.fields())
+                    recipe.dirty = False
+                if self.meals_changed:
+                    storage.save_meals(self.plan.iter_meal_keys())
+                else:
+                    if self.removed:
+                        remaining = (key for key in self.plan.iter_meal_keys() if key not in self.added)
+                        storage.remove_meals(self.removed, remaining)
+                    if self.added:
+                        storage.add_meals(self.added)
+                if self.diet_changed:
+                    storage.save_diet(self.plan.diet)
+            self.clear()
+
+def locked(method):
+    """ Runs a MealPlan method while holding the plan's lock """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
 class MealPlan:
     
-    def __init__(self, diet_file=saved_diet, meal_file=saved_meals, recipe_dir=saved_recipes):
-        """ Initializes a Meal Plan """
-        self.meals = []
+    def __init__(self, diet_file=saved_diet, meal_file=saved_meals, recipe_dir=saved_recipes, workers=1,
+                 pool='process', storage=None, write_delay=0, snapshot_file=saved_snapshot):
+        """
+        Initializes a Meal Plan
+        storage defaults to the csv/text files (FileStorage); pass a SQLiteStorage to use a database
+        workers > 1 parses the recipe directory in parallel on a 'process' or 'thread' pool
+        write_delay > 0 holds edits for that many seconds and saves them together
+        snapshot_file caches the parsed files for the next start, beside the meal file (None turns it off)
+        """
+        self.meals = MealStore()
         self.recipes = []
+        self.registry = RecipeRegistry() # this plan's Recipe objects, since their scores depend on its diet
         self.diet = {}
+        self.diet_index = DietIndex()
+        self.matrix = IngredientMatrix()
+        self.search_index = RecipeSearch() # kept in step with self.recipes
+        self.recipe_totals = None # per matrix row (restricted, other, banned), set by check_recipes
+        self.totals = None # DailyTotals over all meals, rebuilt when stale
+        self.batch_depth = 0 # open batch() blocks
+        self.batch_snapshot = None
+        self.rescore = False # check_recipes is due when the batch exits
+        self.rescore_foods = set() # foods whose recipes are re-scored when the batch exits
         
         self.diet_file = diet_file
         self.meal_file = meal_file
         self.recipe_dir = recipe_dir
+        if storage is None:
+            storage = FileStorage(diet_file, meal_file, recipe_dir, workers, pool, snapshot_file)
+        self.storage = storage
+        self.lock = threading.RLock()
+        self.writes = WriteBehind(self, write_delay)
         
         self.update()
     
+    @locked
     def update(self):
         """ Updates meals, recipes, and diet plan """
+        self.writes.flush() # don't lose pending edits
         self.read_recipes()
         self.read_meals()
         self.read_diet()
         self.check_recipes()
+        self.storage.checkpoint()
     
     def read_recipes(self):
-        """ Reads all recipes from a directory and returns a list of Meal objects  """
-        self.recipes = []
-        if not os.path.exists(self.recipe_dir):
-            os.mkdir(self.recipe_dir)
-        for file in glob.glob(self.recipe_dir+"*"):
-            file = os.path.basename(file)
-            self.recipes.append(Recipe.from_file(file))
+        """ Reads all recipes from storage """
+        self.recipes = [self.registry.load(filename, self.recipe_dir, fields)
+                        for filename, fields in self.storage.load_recipes()]
+        self.index_recipes()
     
     def read_meals(self):
-        """ Reads meals from saved meal file """
-        self.meals = []
-        if not os.path.exists(self.meal_file):
-            data = pd.DataFrame(columns=meal_columns)
-            data.to_csv(self.meal_file, index=False)
-        else:
-            data = pd.read_csv(self.meal_file)
-        for i in range(len(data)):
-            m_date = date.fromisoformat(data.date[i])
-            self.meals.append(Meal(data.filename[i], m_date=m_date, category=data.category[i]))
+        """ Reads meals from storage """
+        self.meals = MealStore.from_rows(self.storage.load_meals(), self.recipe_dir, self.registry)
+        self.index_meals()
     
     def read_diet(self):
-        """ Reads in a diet plan from a file """
-        if not os.path.exists(self.diet_file):
-            data = pd.DataFrame(columns=diet_columns)
-            data.to_csv(self.diet_file, index=False)
+        """ Reads in a diet plan from storage """
+        self.diet = self.storage.load_diet()
+        self.diet_index = DietIndex(self.diet)
+    
+    def index_recipes(self):
+        """ Rebuilds the lookups derived from the recipe list """
+        self.matrix = IngredientMatrix(self.recipes)
+        self.search_index.sync(self.recipes)
+        self.recipe_totals = None
+        self.totals = None
+    
+    def index_meals(self):
+        """ Marks the totals derived from the meal list as stale """
+        self.totals = None
+    
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Groups edits: saving and re-scoring wait until the block exits,
+        and an exception inside the block rolls all of its edits back
+        """
+        with self.lock:
+            if self.batch_depth==0:
+                self.writes.flush()
+                self.batch_snapshot = (self.meals.copy(), list(self.recipes),
+                                       {category: list(foods) for category, foods in self.diet.items()})
+            self.batch_depth += 1
+            try:
+                yield self
+            except BaseException:
+                self.batch_depth -= 1
+                if self.batch_depth==0:
+                    self.rollback()
+                raise
+            self.batch_depth -= 1
+            if self.batch_depth==0:
+                self.batch_snapshot = None
+                try:
+                    if self.rescore:
+                        self.check_recipes()
+                    elif self.rescore_foods:
+                        self.check_food_recipes(self.rescore_foods)
+                finally:
+                    # The edits are kept either way, so they must still be saved
+                    self.writes.schedule()
+    
+    def rollback(self):
+        """ Puts the plan back the way it was when the batch started """
+        meals, recipes, diet = self.batch_snapshot
+        self.batch_snapshot = None
+        saved = self.writes.recipes
+        self.writes.clear()
+        self.meals, self.recipes, self.diet = meals, recipes, diet
+        # Recipes saved in the batch go back to their stored fields; new ones are dropped
+        for filename, recipe in saved.items():
+            fields = self.storage.load_recipe(filename)
+            if fields is None:
+                self.registry.remove(recipe)
+            else:
+                recipe.set_fields(fields)
+        for recipe in self.recipes:
+            self.registry.add(recipe)
+        self.diet_index = DietIndex(self.diet)
+        self.index_recipes()
+        self.index_meals()
+        self.check_recipes()
+    
+    def rescore_recipes(self, foods=None):
+        """ Re-scores every recipe (or only those using one of the foods) now, or when the open batch exits """
+        if self.batch_depth:
+            if foods is None:
+                self.rescore = True
+            else:
+                self.rescore_foods.update(foods)
+        elif foods is None or self.recipe_totals is None:
+            self.check_recipes()
         else:
-            data = pd.read_csv(self.diet_file)
-            data = data.fillna('')
-        for col in data.columns:
-            self.diet[col] = [val for val in  data[col] if val!=""]
+            self.check_food_recipes(foods)
     
-    def get_meals(self, start, days):
-        """ Gets all meals between start and start + # days """
+    @locked
+    def get_meals(self, start, days, category=None):
+        """ Gets all meals between start and start + # days (only one category, if given) """
         td = timedelta(days=days)
-        if len(self.meals)==0:
-            return []
-        meals = np.array(self.meals)
-        file = os.path.basename(meals[0].filename)
-        meals = meals[meals>=Meal(file, m_date=start)]
-        meals = meals[meals<Meal(file, m_date=start+td)]
-        return list(meals)
+        return self.meals.between(start, start+td, category)
     
+    def own_meal(self, meal):
+        """ Returns the meal made from this plan's copy of its recipe, if it was made from another registry's """
+        recipe = meal.base_recipe
+        own = self.registry.recipes.get(recipe.filename)
+        if own is recipe:
+            return meal
+        if own is None:
+            if not os.path.exists(recipe.filename):
+                self.registry.add(recipe) # nothing on file to read a separate copy from
+                return meal
+            own = self.registry.get(recipe.basename, recipe.filename[:-len(recipe.basename)])
+        return Meal.view(own, meal.date, meal.category)
+    
+    @locked
     def add_meal(self, meal):
         """ Adds a meal to the meal list """
-        if type(meal) is Meal and meal not in self.meals:
-            self.meals.append(meal)
-            r = meal.recipe()
-        self.to_file()
-        self.update()
+        if type(meal) is Meal:
+            meal = self.own_meal(meal)
+        if type(meal) is Meal and self.meals.add(meal):
+            key = meal_key(meal)
+            self.totals = None
+            if self.batch_depth:
+                self.rescore = True
+            else:
+                self.check_recipe(meal)
+            self.writes.add_meal(key)
+            self.writes.schedule()
+    
+    def add_meals(self, meals):
+        """ Adds several meals with a single save """
+        with self.batch():
+            for meal in meals:
+                self.add_meal(meal)
     
+    @locked
     def remove_meal(self, meal):
         """ Removes a meal from the meal list """
-        print("remove meal called")
-        if type(meal) is Meal and meal in self.meals:
-            self.meals.remove(meal)
+        if type(meal) is Meal and self.meals.remove(meal):
+            self.totals = None
+            self.writes.remove_meal(meal_key(meal))
+            self.writes.schedule()
         elif type(meal) is Recipe and meal in self.recipes:
-            print("removing recipe:", meal.filename)
             self.remove_recipe(meal)
-        self.to_file()
-        self.update()
     
+    def remove_meals(self, meals):
+        """ Removes several meals with a single save """
+        with self.batch():
+            for meal in meals:
+                self.remove_meal(meal)
+    
+    @locked
     def update_meal(self, old_meal, new_meal):
         """ Updates a meal in the meal list """
-        self.remove_meal(old_meal)
-        self.add_meal(new_meal)
-        self.to_file()
-        self.update()
+        with self.batch():
+            self.remove_meal(old_meal)
+            self.add_meal(new_meal)
     
+    @locked
+    def save_recipe(self, recipe):
+        """ Adds a new recipe or saves changes to an existing one """
+        self.registry.add(recipe)
+        if recipe not in self.recipes:
+            self.recipes.append(recipe)
+        self.matrix.set_recipe(recipe)
+        self.search_index.add(recipe)
+        self.recipe_totals = None # rescored on the next daily_totals()
+        self.totals = None
+        if self.batch_depth:
+            self.rescore = True
+        else:
+            self.check_recipe(recipe)
+        self.writes.save_recipe(recipe)
+        self.writes.schedule()
+    
+    @locked
+    def edit_recipe(self, recipe, changes, old_meal=None, new_meal=None):
+        """ Applies edited fields to a recipe and saves it, moving the meal if its date/category changed """
+        with self.batch():
+            for attr, value in changes.items():
+                setattr(recipe, attr, value)
+            self.save_recipe(recipe)
+            if old_meal is not None and new_meal!=old_meal:
+                self.update_meal(old_meal, new_meal)
+    
+    @locked
     def remove_recipe(self, recipe):
-        """ Removes a recipe from the list (and the file tree) """
-        if recipe in self.recipes:
-            self.recipes.remove(recipe)
-            os.remove(recipe.filename)
-        for meal in self.meals:
-            print("comparing:", meal.filename, recipe.filename)
-            if meal.filename==recipe.filename:
-                self.remove_meal(meal)
+        """ Removes a recipe from the list (and from storage), along with every meal made from it """
+        with self.batch():
+            if recipe in self.recipes:
+                self.recipes.remove(recipe)
+                self.registry.remove(recipe)
+                self.matrix.remove_recipe(recipe)
+                self.search_index.remove(recipe)
+                self.recipe_totals = None # matrix rows moved
+                self.writes.delete_recipe(recipe)
+            # Drop the recipe's meals in one column scan
+            for key in self.meals.remove_recipe(recipe):
+                self.writes.remove_meal(key)
+            self.totals = None
+    
+    @locked
+    def get_saved_meals(self, start, days):
+        """
+        Returns the (filename, date, category) keys saved between start and start + # days, in date order
+        Storages with a date index (SQLite) answer with a range query; others are read from memory
+        """
+        self.writes.flush()
+        end = start+timedelta(days=days)
+        if hasattr(self.storage, 'meals_between'):
+            return self.storage.meals_between(start, end)
+        return [meal_key(meal) for meal in self.meals.between(start, end)]
+    
+    @locked
+    def get_recipe_meals(self, recipe):
+        """ Returns all meals made from a recipe """
+        return self.meals.recipe_meals(recipe)
+    
+    @locked
+    def search_recipes(self, query, limit=50):
+        """ Returns up to limit recipes matching a search-as-you-type query (all recipes if it's blank) """
+        if not search_tokens(query):
+            return self.recipes[:limit]
+        return self.search_index.search(query, limit)
+    
+    @locked
+    def recipes_using(self, food):
+        """ Returns the recipes that use a food """
+        rows = self.matrix.food_rows([food])
+        return [self.matrix.recipes[row] for row in rows.tolist()]
     
+    @locked
     def add_food(self, food, category):
         """ Adds a food to the diet """
         self.diet[category].append(food)
-        self.to_file()
+        self.diet_index.add(food, category)
+        self.save_diet()
+        self.rescore_recipes([food])
     
+    @locked
     def remove_food(self, food):
         """ Removes a food from the diet """
-        for category in self.food_columns:
-            if food in self.diet[category]:
-                self.diet[category].remove(food)
-        self.to_file()
+        name = normalize_food(food)
+        for category in diet_columns:
+            self.diet[category] = [f for f in self.diet[category] if normalize_food(f)!=name]
+        self.diet_index.remove(food)
+        self.save_diet()
+        self.rescore_recipes([food])
     
+    @locked
     def to_file(self):
-        """ Saves all meal info to a csv file """
-        # Recipes
+        """ Saves every changed recipe, pending meal edit and the diet to storage right away """
         for recipe in self.recipes:
-            recipe.to_file()
-        # Save Diet
-        diet = pd.DataFrame()
-        for key in self.diet:
-            df = pd.DataFrame(data=self.diet[key])
-            diet = pd.concat([diet,df], ignore_index=True, axis=1)
-        diet = diet.fillna('')
-        diet.columns = diet_columns
-        diet.to_csv(self.diet_file, index=False)
-        # Meals
-        data = [[os.path.basename(meal.filename), meal.date, meal.category] for meal in self.meals]
-        meals = pd.DataFrame(data=data, columns=meal_columns)
-        meals.to_csv(self.meal_file, index=False)
+            if recipe.dirty:
+                self.writes.save_recipe(recipe)
+        self.writes.flush()
+        self.storage.checkpoint()
     
+    def save_diet(self):
+        """ Queues the diet plan to be saved """
+        self.writes.save_diet()
+        self.writes.schedule()
+    
+    def save_meals(self):
+        """ Queues the whole meal list to be saved """
+        self.writes.save_meals()
+        self.writes.schedule()
+    
+    @locked
+    def iter_meal_keys(self):
+        """ Yields the keys of all meals, in date order """
+        return iter(self.meals.keys())
+    
+    @locked
     def check_plan(self, start, days):
         """ Checks the meal plan between start and start + days """
-        meals = self.get_meals(start, days)
-        foods = calc_foods(meals)
-        return check_foods(foods, self.diet)
+        accept, percent = compliance(*self.daily_totals().window(start.toordinal(), days))
+        return bool(accept), float(percent)
+    
+    @locked
+    def check_windows(self, start, end, days=7):
+        """
+        Checks every window of #days starting on each date from start up to (not including) end
+        Returns accept and percent arrays, one entry per window start
+        """
+        starts = np.arange(start.toordinal(), end.toordinal())
+        return compliance(*self.daily_totals().window(starts, days))
+    
+    @locked
+    def daily_totals(self):
+        """ Returns cumulative per-day diet totals, rebuilding them if meals or scores changed """
+        if self.totals is None:
+            store = self.meals
+            recipe_ids = store.recipe_ids[:store.size]
+            used = [store.recipes[rid] for rid in np.unique(recipe_ids)]
+            # Meals whose recipe isn't in the plan's recipe list still need a matrix row
+            missing = [recipe for recipe in used if recipe.filename not in self.matrix.rows]
+            if missing or self.recipe_totals is None:
+                for recipe in missing:
+                    self.matrix.set_recipe(recipe)
+                self.check_recipes()
+            id_rows = np.zeros(len(store.recipes), dtype=np.int64)
+            for recipe in used:
+                id_rows[store.ids[recipe.basename]] = self.matrix.rows[recipe.filename]
+            rows = id_rows[recipe_ids]
+            self.totals = DailyTotals(store.ordinals[:store.size], *(w[rows] for w in self.recipe_totals))
+        return self.totals
     
     def check_recipes(self):
         """ Checks recipes and meals and updates them with their percentages """
-        for recipe in self.meals+self.recipes:
-            foods = calc_foods([recipe])
-            recipe.accept, recipe.percent = check_foods(foods, self.diet)
\ No newline at end of file
+        # Meals share their Recipe, so scoring each recipe covers the meals too
+        self.rescore = False
+        self.rescore_foods = set()
+        self.recipe_totals = self.matrix.class_totals(self.diet_index)
+        self.totals = None
+        accept, percent = compliance(*self.recipe_totals)
+        for recipe, ok, amount in zip(self.matrix.recipes, accept.tolist(), percent.tolist()):
+            recipe.accept, recipe.percent = ok, amount
+    
+    def check_food_recipes(self, foods):
+        """ Re-scores only the recipes that use one of the foods, and the meal totals if any are planned """
+        foods, self.rescore_foods = set(foods), set()
+        if self.recipe_totals is None:
+            # Recipes changed since the last full scoring, so there are no rows to patch
+            self.check_recipes()
+            return
+        rows = self.matrix.food_rows(foods)
+        if len(rows)==0:
+            return
+        new_totals = self.matrix.class_totals(self.diet_index, rows)
+        for totals, new in zip(self.recipe_totals, new_totals):
+            totals[rows] = new
+        recipes = [self.matrix.recipes[row] for row in rows.tolist()]
+        accept, percent = compliance(*new_totals)
+        for recipe, ok, amount in zip(recipes, accept.tolist(), percent.tolist()):
+            recipe.accept, recipe.percent = ok, amount
+        # The daily totals only go stale if one of these recipes is on the plan
+        store = self.meals
+        if any(store.uses(store.ids[recipe.basename]) for recipe in recipes if recipe.basename in store.ids):
+            self.totals = None
+    
+    def check_recipe(self, recipe):
+        """ Checks a single recipe or meal and updates its percentage """
+        foods = calc_foods([recipe])
+        recipe.accept, recipe.percent = check_foods(foods, self.diet_index)
\ No newline at end of file